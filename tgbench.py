@@ -0,0 +1,888 @@
+#!/usr/bin/env python3
+
+import argparse
+import html
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from collections import defaultdict
+from contextlib import redirect_stdout
+from html2text import HTML2Text
+from itertools import compress
+from tgcolumns import TgColumns
+from tgdump import TgDump, TgHtmlParser, TgJsonParser, TgTextConverter, message_projection
+from tgsearch import TgSearchIndex, words
+from tgstore import TgStore
+from tgthreads import TgThreads
+from tggraph import TgGraph
+from tgdumpanal import COMMAND_FIELDS, find_replied_to, report_aggregator, tg_dump_messages, top_n, wc_count, wc_count_parallel, wc_frequencies, wc_stopwords, wc_word, wc_word_classifier, wc_words
+from wordcloud import WordCloud
+
+"""
+Benchmarks for the tgdump parsers and the tgdumpanal reports, run against
+synthetic exports so they can be reproduced without a real Telegram dump.
+
+$ ./tgbench.py html --messages 100000
+$ ./tgbench.py extract --messages 100000
+$ ./tgbench.py topn --keys 1000000
+$ ./tgbench.py text --export ~/Downloads/Telegram\ Desktop/ChatExport_2022-08-16
+$ ./tgbench.py merge --exports 10
+$ ./tgbench.py wordcloud --messages 100000
+$ ./tgbench.py search --messages 200000
+$ ./tgbench.py range --messages 1000000
+$ ./tgbench.py dump --messages 200000
+$ ./tgbench.py graph --messages 200000
+$ ./tgbench.py threads --messages 200000
+$ ./tgbench.py records --messages 5000000
+"""
+
+NAMES = ["c0ldbru", "pubkraal", "b1n/&lt;", "Skyehopper", "J9", "Nikolaevarius", "null_exception", "Deleted Account"]
+WORDS = "really we just want to get on there drinking with us again and onto our car this next time lol the poop knife audience glorious talk".split()
+
+HTML_HEADER = """<!DOCTYPE html>
+<html>
+
+ <head>
+
+  <meta charset="utf-8"/>
+<title>Exported Data</title>
+
+ </head>
+
+ <body onload="CheckLocation();">
+
+  <div class="page_wrap">
+
+   <div class="page_header">
+
+    <div class="content">
+
+     <div class="text bold">
+Synthetic Group
+     </div>
+
+    </div>
+
+   </div>
+
+   <div class="page_body chat_page">
+
+    <div class="history">
+
+"""
+
+HTML_FOOTER = """    </div>
+
+   </div>
+
+  </div>
+
+ </body>
+
+</html>
+"""
+
+
+def synth_html_text(rng, recent_ids):
+    words = []
+    for _ in range(rng.randint(1, 30)):
+        r = rng.random()
+        if r < 0.04:
+            words.append('<a href="" onclick="return ShowMentionName()">{}</a>'.format(rng.choice(NAMES)))
+        elif r < 0.07:
+            handle = rng.choice(WORDS)
+            words.append('<a href="https://t.me/{}">@{}</a>'.format(handle, handle))
+        elif r < 0.09 and recent_ids:
+            _id = rng.choice(recent_ids)
+            words.append('<a href="#go_to_message{}" onclick="return GoToMessage({})">this message</a>'.format(_id, _id))
+        elif r < 0.11:
+            words.append("<strong>{}</strong>".format(rng.choice(WORDS)))
+        elif r < 0.12:
+            words.append("<br>")
+        elif r < 0.13:
+            words.append("&quot;{}&quot;".format(rng.choice(WORDS)))
+        else:
+            words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+
+def synth_html_dump(path, count, per_file=1000, seed=1):
+    '''
+    Writes count messages to messages*.html files in path, laid out the
+    way Telegram Desktop's HTML export lays them out.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    _id = 1000
+    timestamp = 1600000000
+    ids = []
+    for fileno in range((count + per_file - 1) // per_file):
+        filename = "messages.html" if fileno == 0 else "messages{}.html".format(fileno + 1)
+        lines = [HTML_HEADER]
+        previous = None
+        for _ in range(min(per_file, count - fileno * per_file)):
+            _id += rng.choice([1, 1, 1, 2, 5])
+            timestamp += rng.randint(1, 900)
+            name = rng.choice(NAMES)
+            joined = name == previous and rng.random() < 0.7
+            lines.append('     <div class="message default clearfix{}" id="message{}">\n\n'.format(" joined" if joined else "", _id))
+            if not joined:
+                lines.append('      <div class="pull_left userpic_wrap">\n\n'
+                             '       <div class="userpic userpic2" style="width: 42px; height: 42px">\n\n'
+                             '        <div class="initials" style="line-height: 42px">\nX\n        </div>\n\n'
+                             '       </div>\n\n      </div>\n\n')
+            lines.append('      <div class="body">\n\n')
+            lines.append('       <div class="pull_right date details" title="{}">\n00:00\n       </div>\n\n'.format(
+                time.strftime("%d.%m.%Y %H:%M:%S", time.gmtime(timestamp))))
+            if not joined:
+                lines.append('       <div class="from_name">\n{} \n       </div>\n\n'.format(name))
+            if ids and rng.random() < 0.3:
+                reply = rng.choice(ids[-200:])
+                lines.append('       <div class="reply_to details">\nIn reply to <a href="#go_to_message{}" onclick="return GoToMessage({})">this message</a>\n       </div>\n\n'.format(reply, reply))
+            if rng.random() < 0.1:
+                lines.append('       <div class="media_wrap clearfix">\n\n'
+                             '        <div class="media clearfix pull_left media_photo">\nPhoto\n        </div>\n\n'
+                             '       </div>\n\n')
+            lines.append('       <div class="text">\n{}\n       </div>\n\n'.format(synth_html_text(rng, ids[-50:])))
+            lines.append('      </div>\n\n     </div>\n\n')
+            ids.append(_id)
+            previous = name
+        lines.append(HTML_FOOTER)
+        with open(os.path.join(path, filename), "w") as HTML:
+            HTML.write("".join(lines))
+    return path
+
+
+def bench(label, fn, repeat=3, setup=None, count=None):
+    '''
+    Runs fn repeat times and prints the best wall clock time, and the rate
+    if fn handles count items per run.
+    If setup is given, its result is passed to fn and setup is not timed.
+    Returns the result of the last run.
+    '''
+    best = None
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if count:
+        print("{:<40} {:>10.3f}s {:>12.0f}/s".format(label, best, count / best))
+    else:
+        print("{:<40} {:>10.3f}s".format(label, best))
+    return result
+
+
+def legacy_parse_messages(parser, lines):
+    '''
+    The readlines()/pop(0) scanner that TgHtmlParser.parse_messages replaced,
+    kept as the reference for bench_html.  reply_to starts out as a string
+    so that multi-line "In reply to" blocks do not raise.
+    '''
+    messages = {}
+    while '<div class="body">' not in lines[0]:
+        lines.pop(0)
+    msg = {"id": None, "from_name": None, "timestamp": None, "text": "", "message_links": [], "mentions": [], "media": "", "reply_to": ""}
+    target = None
+    wait_for_new = True
+    for line in lines:
+        if "</div" in line:
+            target = None
+        elif "<div" in line:
+            div = parser.parse_div_line(line)
+            target = None
+            if div["class"].startswith("message default clearfix"):
+                wait_for_new = False
+                if msg["id"]:
+                    if msg["timestamp"] is None:
+                        msg["timestamp"] = messages[-1]["timestamp"]
+                    messages[msg["id"]] = parser.post_process(msg)
+                from_name = None
+                if div["class"].endswith("joined"):
+                    from_name = msg["from_name"]
+                msg = {"from_name": from_name, "timestamp": None, "text": "", "message_links": [], "mentions": [], "media": "", "reply_to": ""}
+                msg["id"] = int(div["id"].replace("message", ""))
+            elif div["class"] == "forwarded body":
+                wait_for_new = True
+            elif div["class"] == "from_name":
+                target = "from_name"
+            elif div["class"] == "text":
+                target = "text"
+            elif div["class"] == "pull_right date details":
+                msg["timestamp"] = div["title"]
+                try:
+                    if 'UTC' in msg["timestamp"]:
+                        msg["timestamp"] = time.mktime(time.strptime(msg["timestamp"], '%d.%m.%Y %H:%M:%S UTC%z'))
+                    else:
+                        msg["timestamp"] = time.mktime(time.strptime(msg["timestamp"], '%d.%m.%Y %H:%M:%S'))
+                except:
+                    msg["timestamp"] = None
+            elif div["class"] == "media_wrap clearfix":
+                target = "media"
+            elif div["class"] == "reply_to details":
+                target = "reply_to"
+        elif wait_for_new:
+            continue
+        elif target is not None:
+            if target == "from_name":
+                if "<span" in line:
+                    name, details = line.split(" ", 1)
+                    line = name
+                try:
+                    msg[target] = html.unescape(line.strip())
+                except:
+                    msg[target] = line.strip()
+                target = None
+            else:
+                msg[target] = msg[target] + line
+    if msg["id"]:
+        if msg["timestamp"] is None:
+            msg["timestamp"] = messages[-1]["timestamp"]
+        messages[msg["id"]] = parser.post_process(msg)
+    return messages
+
+
+class ScanOnlyParser(TgHtmlParser):
+    """
+    TgHtmlParser without the html2text post-processing, so the scanners
+    themselves can be timed.
+    """
+    def post_process(self, msg):
+        return msg
+
+
+def bench_html(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        # one big file, so the per-file header and line list costs show up
+        synth_html_dump(tmp, args.messages, per_file=args.messages)
+        path = os.path.join(tmp, "messages.html")
+        print("{} messages, {:.1f} MB".format(args.messages, os.path.getsize(path) / 1e6))
+
+        for label, parser in (("scan only", ScanOnlyParser(tmp)), ("full parse", TgHtmlParser(tmp))):
+            def legacy():
+                with open(path, "r") as MESSAGES:
+                    return legacy_parse_messages(parser, MESSAGES.readlines())
+
+            old = bench("{}: readlines + pop(0) scanner".format(label), legacy, args.repeat)
+            new = bench("{}: streaming scanner".format(label), lambda: parser.parse_file(path), args.repeat)
+            if old != new:
+                raise Exception("streaming scanner output differs from the reference scanner")
+
+
+class BodyCollector(TgHtmlParser):
+    """
+    TgHtmlParser that keeps the message bodies handed to html-to-text
+    conversion instead of converting them.
+    """
+    def __init__(self, directory):
+        TgHtmlParser.__init__(self, directory)
+        self.bodies = []
+        self.html_to_text = self.collect
+
+    def collect(self, text):
+        self.bodies.append(text)
+        return text
+
+
+def bench_text(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.export:
+            synth_html_dump(tmp, args.messages)
+        collector = BodyCollector(args.export or tmp)
+        collector.parse()
+    bodies = collector.bodies
+    print("{} message bodies, {} distinct".format(len(bodies), len(set(bodies))))
+
+    def shared():
+        parser = HTML2Text()
+        result = []
+        for body in bodies:
+            parser.feed(body)
+            result.append(parser.finish())
+        return result
+
+    def convert_all(convert):
+        return [convert(body) for body in bodies]
+
+    bench("one shared HTML2Text", shared, args.repeat, count=len(bodies))
+    fresh = bench("HTML2Text per message", lambda: convert_all(TgTextConverter().html2text), args.repeat, count=len(bodies))
+    uncached = bench("TgTextConverter, no cache", convert_all, args.repeat, lambda: TgTextConverter(cache_size=0), len(bodies))
+    cached = bench("TgTextConverter", convert_all, args.repeat, TgTextConverter, len(bodies))
+    if uncached != fresh or cached != fresh:
+        raise Exception("TgTextConverter output differs from HTML2Text")
+    convert = TgTextConverter(cache_size=0)
+    for body in bodies:
+        convert(body)
+    print("{:.1%} of bodies need HTML2Text".format(convert.fallbacks / len(bodies)))
+
+
+ANCHOR_CASES = [
+    'plain text',
+    '<a href="https://t.me/x">@x</a>',
+    '<a href="#go_to_message5" onclick="return GoToMessage(5)">this message</a> and <a href="" onclick="return ShowMentionName()">J9</a>',
+    '<a href="https://x.com/?q=1" onclick="return GoToMessage(5)">x</a>',
+    '<a href="" onclick="return ShowMentionName()">open',
+    '<a href="" onclick="return ShowMentionName()"><strong>J9</strong></a>',
+    '<a href="#go_to_message5" onclick="return GoToMessage(x)">bad</a>',
+    'GoToMessage(5) ShowMentionName()">x</a>',
+    '<a href="#go_to_message5">no onclick</a> <a href="" onclick="return GoToMessage(6)">six</a>',
+    '<a href="x" title="t">title</a>',
+    '<a href="x">GoToMessage(7)</a>',
+    '<a href="ShowMentionName()">x</a>',
+    '<a href="a>b">c</a>',
+    '<a href="x">multi\nline</a>',
+    '<a href="x"></a><a href="y">y</a>',
+]
+
+DIV_CASES = [
+    '<div class="text">\n',
+    '       <div class="message default clearfix joined" id="message12">\n',
+    '      <div class="pull_right date details" title="16.08.2022 13:36:42 UTC-07:00">\n',
+    '<div id="message12" class="message default clearfix">\n',
+    '<div class="text">inline <a href="x">text</a>\n',
+    '<div class="a" class="b">\n',
+    '<div class="a" data-x="1">\n',
+]
+
+
+# the three anchors Telegram writes into message text: plain links, links to
+# other messages and mentions
+ANCHOR_RE = re.compile(r'<a href="([^">\n]*)"(?: onclick="return (?:GoToMessage\((\d+)\)|(ShowMentionName)\(\))")?>([^<\n]*)</a>')
+
+
+def regex_anchors(parser, text):
+    """
+    What TgHtmlParser.post_process does with the anchors in a message text:
+    (text with anchors replaced, message links, mentions).
+    """
+    message_links = []
+    mentions = []
+    if '<a href="#go_to_message' in text:
+        message_links = parser.message_link_re.findall(text)
+    if "ShowMentionName" in text:
+        mentions = parser.mention_re.findall(text)
+    return (parser.href_re.sub("<1>", text), message_links, mentions)
+
+
+def combined_anchors(parser, text):
+    """
+    regex_anchors from one scan with ANCHOR_RE.  Substring counts make sure
+    every "<a href", GoToMessage and ShowMentionName is inside an anchor
+    ANCHOR_RE understands; when one is not, the three regexes are used.
+    """
+    # split leaves the text around the anchors and the four groups of each
+    # anchor: href, message link, mention, body
+    parts = ANCHOR_RE.split(text)
+    if text.count("<a href") != len(parts) // 5:
+        return regex_anchors(parser, text)
+    message_links = list(filter(None, parts[2::5]))
+    mentions = list(compress(parts[4::5], parts[3::5]))
+    if text.count("GoToMessage(") + text.count("ShowMentionName") != len(message_links) + len(mentions):
+        return regex_anchors(parser, text)
+    if message_links and '<a href="#go_to_message' not in text:
+        message_links = []
+    return ("<1>".join(parts[::5]), message_links, mentions)
+
+
+def bench_extract(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        synth_html_dump(tmp, args.messages)
+        parser = ScanOnlyParser(tmp)
+        texts = [msg["text"].strip() for msg in parser.parse()[0].values() if msg["text"]]
+        div_lines = []
+        for path in parser.message_files(tmp):
+            with open(path, "r") as MESSAGES:
+                div_lines.extend(line for line in MESSAGES if "<div" in line and "</div" not in line)
+    print("{} message texts, {} div lines".format(len(texts), len(div_lines)))
+
+    def legacy_div(line):
+        return dict(parser.div_re.findall(line))
+
+    for text in texts + ANCHOR_CASES:
+        if combined_anchors(parser, text) != regex_anchors(parser, text):
+            raise Exception("combined anchor scan differs from the regexes on {!r}".format(text))
+    for line in div_lines + DIV_CASES:
+        if parser.parse_div_line(line) != legacy_div(line):
+            raise Exception("parse_div_line differs from div_re on {!r}".format(line))
+
+    plain = [text for text in texts if "<a" not in text]
+    for label, sample in (("all texts", texts), ("texts without anchors", plain)):
+        bench("anchors, {}: regexes".format(label), lambda: [regex_anchors(parser, text) for text in sample], args.repeat, count=len(sample))
+        bench("anchors, {}: one scan".format(label), lambda: [combined_anchors(parser, text) for text in sample], args.repeat, count=len(sample))
+    bench("div lines: div_re.findall", lambda: [legacy_div(line) for line in div_lines], args.repeat, count=len(div_lines))
+    bench("div lines: parse_div_line", lambda: [parser.parse_div_line(line) for line in div_lines], args.repeat, count=len(div_lines))
+
+
+def peak_memory(fn):
+    '''
+    Runs fn and returns the peak memory it allocated, in MB.
+    '''
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1e6
+
+
+def bench_wordcloud(args):
+    rng = random.Random(1)
+    vocabulary = ["{}{}".format(rng.choice(WORDS), n) for n in range(args.vocabulary)] + WORDS * 50
+    texts = [" ".join(rng.choice(vocabulary) for _ in range(12)) for _ in range(args.messages)]
+    print("{} messages, {} distinct words".format(args.messages, len(set(vocabulary))))
+
+    def joined(collocations):
+        words = list(wc_words(texts, wc_word_classifier(set())))
+        topwords = defaultdict(int)
+        for word in words:
+            topwords[word] += 1
+        return (dict(topwords), WordCloud(collocations=collocations).process_text(" ".join(words)))
+
+    def streamed(collocations):
+        counts, frequencies = wc_frequencies(wc_words(texts, wc_word_classifier(set())), WordCloud(collocations=collocations))
+        return (dict(counts), frequencies)
+
+    # chat vocabulary is roughly Zipf distributed
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    tokens = rng.choices(vocabulary, weights, k=args.messages * 12)
+    excluded = set(WORDS[:5])
+    bench("filter every word", lambda: [wc_word(token, excluded) for token in tokens], args.repeat, count=len(tokens))
+    classify = wc_word_classifier(excluded)
+    # start each run with an empty cache
+    cached = bench("filter with word cache", lambda _: [classify(token) for token in tokens], args.repeat, classify.cache_clear, len(tokens))
+    if cached != [wc_word(token, excluded) for token in tokens]:
+        raise Exception("cached word filtering differs")
+    info = classify.cache_info()
+    print("word cache hit rate {:.1%}".format(info.hits / (info.hits + info.misses)))
+
+    wc = WordCloud(collocations=False)
+    serial = bench("count words serially", lambda: wc_count(wc_words(texts, wc_word_classifier(set())), wc_stopwords(wc), False), args.repeat)
+    for jobs in args.jobs:
+        counted = bench("count words, pool of {}".format(jobs), lambda: wc_count_parallel(iter(texts), set(), 100000, wc, jobs)[0], args.repeat)
+        if counted[:3] != serial[:3]:
+            raise Exception("word counts from {} processes differ".format(jobs))
+
+    for collocations in (False, True):
+        label = "phrases" if collocations else "words"
+        old = bench("{}: word list + joined text".format(label), lambda: joined(collocations), args.repeat)
+        new = bench("{}: streamed counts".format(label), lambda: streamed(collocations), args.repeat)
+        if old != new:
+            raise Exception("streamed word frequencies differ from WordCloud.process_text")
+        print("peak memory {:.1f} MB joined, {:.1f} MB streamed".format(
+            peak_memory(lambda: joined(collocations)), peak_memory(lambda: streamed(collocations))))
+
+
+def legacy_top_n(dct, n):
+    '''
+    The full-sort top_n that tgdumpanal.top_n replaced.
+    '''
+    sorted_list_of_tuples = list(filter(lambda x: x[0] != "Deleted Account", sorted(dct.items(), key = lambda foo: foo[1])))
+    if n == 1:
+        return [sorted_list_of_tuples[-1]]
+    return sorted_list_of_tuples[-1 * n :]
+
+
+def bench_topn(args):
+    # word counts follow a power law, with plenty of ties in the tail
+    rng = random.Random(1)
+    counts = {"word{}".format(i): int(args.keys / (i + 1) ** 1.1) + rng.randint(0, 3) for i in range(args.keys)}
+    counts["Deleted Account"] = args.keys
+    print("{} keys".format(len(counts)))
+    for n in (1, 20, 100):
+        old = bench("sorted top_n, n={}".format(n), lambda: legacy_top_n(counts, n), args.repeat)
+        new = bench("heap top_n, n={}".format(n), lambda: top_n(counts, n), args.repeat)
+        if old != new:
+            raise Exception("top_n differs from the full sort for n={}".format(n))
+
+
+def synth_exports(count, messages, overlap=0.9, seed=1):
+    '''
+    Returns count TgDumps shaped like successive JSON exports of one chat:
+    each covers messages ids, shares overlap of them with the one before,
+    and renames, edits and fills in a few of the shared ones.
+    '''
+    rng = random.Random(seed)
+    step = max(1, int(messages * (1 - overlap)))
+    dumps = []
+    for export in range(count):
+        dump = TgDump()
+        for _id in range(export * step, export * step + messages):
+            author = _id % len(NAMES)
+            msg = {
+                "id": _id,
+                "from_name": NAMES[author],
+                "from_id": "user{}".format(author),
+                "timestamp": 1600000000 + _id * 60,
+                "text": " ".join(WORDS[(_id + k) % len(WORDS)] for k in range(8)),
+                "message_links": [],
+                "links": [],
+                "mentions": [],
+                "media": "",
+                "reply_to": [_id - 1] if _id % 3 == 0 else []
+            }
+            roll = rng.random()
+            if roll < 0.01:
+                msg["text"] = msg["text"] + " (edited)"
+            elif roll < 0.02:
+                msg["media"] = None
+            elif roll < 0.025:
+                msg["from_name"] = "Deleted Account"
+            dump[_id] = msg
+        dump.update_earliest_and_latest()
+        dumps.append(dump)
+    return dumps
+
+
+def legacy_merge(messages, other_tgdump):
+    '''
+    The one-dump-at-a-time TgDump.merge that the k-way merge replaced.
+    '''
+    for msg_id, msg in other_tgdump.items():
+        if msg_id not in messages:
+            messages[msg_id] = msg
+            continue
+        for field, value in msg.items():
+            if field not in messages[msg_id]:
+                messages[msg_id][field] = value
+                continue
+            if messages.isnull(value):
+                continue
+            if messages.isnull(messages[msg_id][field]):
+                messages[msg_id][field] = value
+            else:
+                if messages[msg_id][field] == value:
+                    continue
+                if field == "from_name":
+                    if value == "Deleted Account":
+                        continue
+                    messages[msg_id]["from_name"] = value
+                else:
+                    messages[msg_id][field] = value
+    messages.normalize_from_name()
+    messages.update_earliest_and_latest()
+
+
+def bench_merge(args):
+    print("{} exports of {} messages, {:.0%} overlap".format(args.exports, args.messages, args.overlap))
+    setup = lambda: synth_exports(args.exports, args.messages, args.overlap)
+
+    def sequential(dumps):
+        messages = TgDump()
+        for dump in dumps:
+            legacy_merge(messages, dump)
+        return messages
+
+    def k_way(dumps):
+        messages = TgDump()
+        messages.merge(*dumps)
+        return messages
+
+    old = bench("merge one dump at a time", sequential, args.repeat, setup)
+    new = bench("k-way merge", k_way, args.repeat, setup)
+    if old != new:
+        raise Exception("k-way merge differs from merging one dump at a time")
+
+
+def bench_search(args):
+    messages = synth_exports(1, args.messages)[0]
+    word, name = WORDS[3], words(NAMES[1])[0]
+    print("{} messages, searching for {!r} and from:{}".format(args.messages, word, name))
+    legacy_re = re.compile(r"\b{}\b".format(word))
+    legacy = bench("regex over str(msg)", lambda: [msg["id"] for msg in messages.values() if legacy_re.search(str(msg))], args.repeat)
+    index = bench("build index", lambda: TgSearchIndex.build(messages), args.repeat)
+    with tempfile.TemporaryDirectory() as path:
+        bench("save index", lambda: index.save(path), args.repeat)
+        index = bench("load index", lambda: TgSearchIndex.load(path), args.repeat)
+        checks = [
+            (word, lambda msg: word in words(msg["text"])),
+            (word[:3] + "*", lambda msg: any(w.startswith(word[:3]) for w in words(msg["text"]))),
+            ("from:" + name, lambda msg: name in words(msg["from_name"])),
+            ("{} re:{}$".format(word, WORDS[0]), lambda msg: word in words(msg["text"]) and msg["text"].endswith(WORDS[0])),
+        ]
+        for query, check in checks:
+            found = bench("query " + query, lambda: index.search(query, messages).tolist(), args.repeat)
+            if found != sorted(msg_id for msg_id, msg in messages.items() if check(msg)):
+                raise Exception("index search for {!r} differs from checking every message".format(query))
+    if sorted(legacy) != index.search(word, messages).tolist():
+        raise Exception("index search for {!r} differs from the regex".format(word))
+
+
+def bench_range(args):
+    messages = synth_exports(1, args.messages)[0]
+    timestamps = sorted(msg["timestamp"] for msg in messages.values())
+    not_before, not_after = timestamps[len(timestamps) // 3], timestamps[len(timestamps) // 2]
+    print("{} messages, {} in range".format(args.messages, len(timestamps) // 2 - len(timestamps) // 3 + 1))
+
+    def indaterange(msg):
+        return not_before <= msg["timestamp"] <= not_after
+
+    old = bench("select every message", lambda: messages.select(indaterange), args.repeat)
+    bench("build time index", lambda _: messages.between(), args.repeat, lambda: setattr(messages, "time_index", None))
+    new = bench("between", lambda: messages.between(not_before, not_after), args.repeat)
+    if list(old.items()) != list(new.items()):
+        raise Exception("between differs from select")
+    with tempfile.TemporaryDirectory() as path:
+        TgColumns.from_dump(messages).save(path)
+        columns = TgColumns.load(path)
+        old = bench("columns: check every message", lambda: [msg for msg in columns.values() if indaterange(msg)], args.repeat)
+        new = bench("columns: between", lambda: columns.between(not_before, not_after), args.repeat)
+        if old != list(new.values()):
+            raise Exception("TgColumns.between differs from select")
+
+
+def bench_dump(args):
+    messages = synth_exports(1, args.messages)[0]
+    print("{} messages".format(args.messages))
+    with tempfile.TemporaryDirectory() as path:
+        legacy_path = os.path.join(path, "legacy.json")
+
+        def legacy():
+            output = list(messages.values())
+            output.sort(key = lambda msg: int(msg["id"]))
+            with open(legacy_path, "w") as OUT:
+                print(json.dumps(output), file=OUT)
+
+        def streamed(output, compress=None, fast_json=False):
+            options = argparse.Namespace(dumpjson=True, dumpjsonl=False, output=os.path.join(path, output), compress=compress, fast_json=fast_json)
+            return lambda: tg_dump_messages(messages, options)
+
+        bench("list + json.dumps", legacy, args.repeat)
+        bench("streamed", streamed("streamed.json"), args.repeat)
+        with open(legacy_path, "rb") as LEGACY, open(os.path.join(path, "streamed.json"), "rb") as STREAMED:
+            if LEGACY.read() != STREAMED.read():
+                raise Exception("streamed --dumpjson differs from json.dumps of the list")
+        bench("streamed, gzip", streamed("streamed.json.gz"), args.repeat)
+        bench("streamed, fast json", streamed("fast.json", fast_json=True), args.repeat)
+        print("peak memory {:.1f} MB list + json.dumps, {:.1f} MB streamed".format(
+            peak_memory(legacy), peak_memory(streamed("streamed.json"))))
+
+
+def bench_graph(args):
+    messages = synth_exports(1, args.messages)[0]
+    print("{} messages, {} people".format(args.messages, len(NAMES)))
+    old = bench("find_replied_to for everyone", lambda: {name: dict(find_replied_to(messages, name)) for name in NAMES}, args.repeat)
+    graph = bench("build graph", lambda: TgGraph.build(messages), args.repeat)
+    with tempfile.TemporaryDirectory() as path:
+        bench("save graph", lambda: graph.save(path), args.repeat)
+        graph = bench("load graph", lambda: TgGraph.load(path), args.repeat)
+        new = bench("replies of everyone from the graph", lambda: {name: dict(graph.partners("replies", name, len(NAMES))) for name in NAMES}, args.repeat)
+        if old != new:
+            raise Exception("graph replies differ from find_replied_to")
+        bench("top pairs and reciprocity", lambda: (graph.top_pairs("replies", 20), graph.reciprocity("replies")), args.repeat)
+
+
+def legacy_thread_sizes(messages):
+    '''
+    Thread sizes the way they were worked out by hand: follow each
+    message's first reply_to up to a message that replies to nothing (or to
+    a message that is not there), and count the messages under each root.
+    Only right for threads where every message replies to one other.
+    '''
+    sizes = defaultdict(int)
+    for msg in messages.values():
+        while msg["reply_to"] and msg["reply_to"][0] in messages:
+            msg = messages[msg["reply_to"][0]]
+        sizes[msg["reply_to"][0] if msg["reply_to"] else msg["id"]] += 1
+    return sorted(sizes.values(), reverse=True)
+
+
+def bench_threads(args):
+    messages = synth_exports(1, args.messages)[0]
+    for _id, msg in messages.items():
+        # chains of 50, each starting with a reply to a message outside the dump
+        msg["reply_to"] = [_id - 1] if _id % 50 else [-_id - 1]
+    print("{} messages".format(args.messages))
+    old = bench("follow reply chains", lambda: legacy_thread_sizes(messages), args.repeat)
+    threads = bench("union-find threads", lambda: TgThreads(messages), args.repeat)
+    bench("thread stats", lambda: TgThreads(messages).stats(), args.repeat)
+    new = sorted((thread["size"] for thread in threads.stats().values()), reverse=True)
+    if old != new:
+        raise Exception("union-find thread sizes differ from following the reply chains")
+    bench("same_thread for every message", lambda: [threads.same_thread(_id, _id - 1) for _id in messages], args.repeat, count=len(messages))
+
+
+def synth_json_export(path, count, seed=1):
+    '''
+    Writes a result.json-like export of count messages to path.
+    '''
+    rng = random.Random(seed)
+    messages = []
+    for _id in range(count):
+        author = rng.randrange(len(NAMES))
+        message = {
+            "id": _id,
+            "type": "message",
+            "date_unixtime": str(1600000000 + _id * 60),
+            "from": NAMES[author],
+            "from_id": "user{}".format(author),
+            "text": [" ".join(rng.choice(WORDS) for _ in range(8))],
+        }
+        if _id % 3 == 0:
+            message["reply_to_message_id"] = _id - 1
+        if _id % 10 == 0:
+            message["text"].append({"type": "mention", "text": "@" + rng.choice(NAMES)})
+        messages.append(message)
+    with open(path, "w") as EXPORT:
+        json.dump({"name": "Synthetic Group", "messages": messages}, EXPORT)
+
+
+class LegacyJsonParser(TgJsonParser):
+    '''
+    TgJsonParser building a plain dict per message, as it did before
+    TgMessage.
+    '''
+
+    def normalize(self, message):
+        msg = dict(super().normalize(message).as_dict())
+        # un-intern the names, the JSON decoder gives every message its own
+        for field in ("from_name", "from_id"):
+            if isinstance(msg[field], str):
+                msg[field] = "".join(list(msg[field]))
+        for field in ("message_links", "links", "mentions", "reply_to"):
+            msg[field] = list(msg[field])
+        return msg
+
+
+def bench_records(args):
+    with tempfile.TemporaryDirectory() as path:
+        export = os.path.join(path, "result.json")
+        synth_json_export(export, args.messages)
+        print("{} messages".format(args.messages))
+        # keep only what the parser returns, not the decoded export
+        old = LegacyJsonParser(export, streaming=True)()[0]
+        new = bench("parse to TgMessages", lambda: TgJsonParser(export, streaming=True)()[0], args.repeat)
+        if list(old.items()) != list(new.items()):
+            raise Exception("TgMessages differ from the dicts")
+        # the default --report reads every message through __getitem__ and get
+        bench("report counters on dicts", lambda: report_aggregator().run(old), args.repeat)
+        bench("report counters on TgMessages", lambda: report_aggregator().run(new), args.repeat)
+        del old, new
+        print("peak memory {:.1f} MB dicts, {:.1f} MB TgMessages".format(
+            peak_memory(lambda: LegacyJsonParser(export, streaming=True)()),
+            peak_memory(lambda: TgJsonParser(export, streaming=True)())))
+
+
+def bench_plan(args):
+    fields = message_projection(COMMAND_FIELDS[args.command])
+    with tempfile.TemporaryDirectory() as path:
+        export = os.path.join(path, "result.json")
+        synth_json_export(export, args.messages)
+        print("{} messages, --{} reads {}".format(args.messages, args.command, sorted(fields)))
+        old = bench("parse every field", lambda: TgJsonParser(export)()[0], args.repeat)
+        new = bench("parse the planned fields", lambda: TgJsonParser(export, fields=fields)()[0], args.repeat)
+        for msg_id, msg in new.items():
+            if dict(msg.items()) != {field: value for field, value in old[msg_id].items() if field in fields}:
+                raise Exception("Message {} differs from the full parse".format(msg_id))
+        del old, new
+        print("peak memory {:.1f} MB every field, {:.1f} MB planned fields".format(
+            peak_memory(lambda: TgJsonParser(export, streaming=True)()),
+            peak_memory(lambda: TgJsonParser(export, streaming=True, fields=fields)())))
+
+
+def bench_store(args):
+    with tempfile.TemporaryDirectory() as path:
+        exports = {}
+        for name, count in (("ChatExport_1", args.messages), ("ChatExport_2", args.messages + args.delta)):
+            exports[name] = os.path.join(path, name)
+            os.makedirs(exports[name])
+            synth_json_export(os.path.join(exports[name], "result.json"), count)
+        # the same export again, in the new directory the next one lands in
+        exports["ChatExport_3"] = os.path.join(path, "ChatExport_3")
+        shutil.copytree(exports["ChatExport_2"], exports["ChatExport_3"])
+        base = os.path.join(path, "base")
+        with redirect_stdout(io.StringIO()):
+            TgStore(base).ingest([exports["ChatExport_1"]])
+
+        def fresh_store():
+            store = os.path.join(path, "store")
+            shutil.rmtree(store, ignore_errors=True)
+            shutil.copytree(base, store)
+            return TgStore(store)
+
+        def ingest(store, sources, backfill=False):
+            with redirect_stdout(io.StringIO()):
+                return store.ingest(sources, backfill=backfill)
+
+        print("{} messages stored, {} new".format(args.messages, args.delta))
+        old = bench("ingest, parsing every message", lambda store: ingest(store, [exports["ChatExport_2"]], backfill=True), args.repeat, setup=fresh_store)
+        new = bench("ingest above the high-water mark", lambda store: ingest(store, [exports["ChatExport_2"]]), args.repeat, setup=fresh_store)
+        if old != new or new != args.delta:
+            raise Exception("added {} messages parsing everything, {} above the high-water mark".format(old, new))
+
+        def ingested():
+            store = fresh_store()
+            ingest(store, [exports["ChatExport_2"]])
+            return store
+        bench("ingest a copy in a new directory", lambda store: ingest(store, [exports["ChatExport_3"]]), args.repeat, setup=ingested)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", default=3, type=int, help="runs per benchmark, the best one is reported")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+    html = benchmarks.add_parser("html", help="TgHtmlParser.parse_messages on one large messages.html")
+    html.add_argument("--messages", default=100000, type=int, help="number of synthetic messages")
+    html.set_defaults(func=bench_html)
+    topn = benchmarks.add_parser("topn", help="tgdumpanal.top_n on a large word count dict")
+    topn.add_argument("--keys", default=1000000, type=int, help="number of distinct keys")
+    topn.set_defaults(func=bench_topn)
+    text = benchmarks.add_parser("text", help="html to text conversion of message bodies")
+    text.add_argument("--messages", default=100000, type=int, help="number of synthetic messages")
+    text.add_argument("--export", default=None, help="use the message bodies of this HTML export directory instead")
+    text.set_defaults(func=bench_text)
+    extract = benchmarks.add_parser("extract", help="anchor and div attribute extraction, checked against the plain regexes")
+    extract.add_argument("--messages", default=100000, type=int, help="number of synthetic messages")
+    extract.set_defaults(func=bench_extract)
+    wordcloud = benchmarks.add_parser("wordcloud", help="word frequencies for --wc, with peak memory")
+    wordcloud.add_argument("--messages", default=100000, type=int, help="number of synthetic messages")
+    wordcloud.add_argument("--vocabulary", default=20000, type=int, help="number of distinct words")
+    wordcloud.add_argument("--jobs", default=[2, 4], type=int, nargs="+", help="process counts to compare serial counting with")
+    wordcloud.set_defaults(func=bench_wordcloud)
+    merge = benchmarks.add_parser("merge", help="TgDump.merge of overlapping exports")
+    merge.add_argument("--exports", default=10, type=int, help="number of exports to merge")
+    merge.add_argument("--messages", default=200000, type=int, help="messages per export")
+    merge.add_argument("--overlap", default=0.9, type=float, help="fraction of each export shared with the previous one")
+    merge.set_defaults(func=bench_merge)
+    search = benchmarks.add_parser("search", help="--query index against a regex over every message")
+    search.add_argument("--messages", default=200000, type=int, help="number of synthetic messages")
+    search.set_defaults(func=bench_search)
+    range_ = benchmarks.add_parser("range", help="--not_before/--not_after slicing against checking every message")
+    range_.add_argument("--messages", default=1000000, type=int, help="number of synthetic messages")
+    range_.set_defaults(func=bench_range)
+    dump = benchmarks.add_parser("dump", help="--dumpjson written as a stream against json.dumps of a list")
+    dump.add_argument("--messages", default=200000, type=int, help="number of synthetic messages")
+    dump.set_defaults(func=bench_dump)
+    graph = benchmarks.add_parser("graph", help="--relationship graph against find_replied_to")
+    graph.add_argument("--messages", default=200000, type=int, help="number of synthetic messages")
+    graph.set_defaults(func=bench_graph)
+    threads = benchmarks.add_parser("threads", help="--threads union-find against following reply chains")
+    threads.add_argument("--messages", default=200000, type=int, help="number of synthetic messages")
+    threads.set_defaults(func=bench_threads)
+    records = benchmarks.add_parser("records", help="memory of parsed messages as TgMessages against dicts")
+    records.add_argument("--messages", default=1000000, type=int, help="number of synthetic messages")
+    records.set_defaults(func=bench_records)
+    store = benchmarks.add_parser("store", help="TgStore.ingest of a nightly export, against parsing all of it")
+    store.add_argument("--messages", default=200000, type=int, help="number of messages already stored")
+    store.add_argument("--delta", default=2000, type=int, help="number of new messages in the nightly export")
+    store.set_defaults(func=bench_store)
+    plan = benchmarks.add_parser("plan", help="parsing only the fields a command reads against parsing every field")
+    plan.add_argument("--messages", default=200000, type=int, help="number of synthetic messages")
+    plan.add_argument("--command", default="perday", choices=sorted(command for command, fields in COMMAND_FIELDS.items() if fields), help="the command whose fields are parsed (default is perday)")
+    plan.set_defaults(func=bench_plan)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
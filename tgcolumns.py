@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import numpy
+import os
+import uuid
+
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+
+"""
+TgColumns holds the messages of a TgDump column by column instead of as one
+dict per message.  Numeric fields are numpy arrays, repeated strings (names,
+ids, media types) are interned into small tables and stored as indexes, and
+the free-form fields (text, the link/mention/reply lists) are numpy object
+arrays.  Rows keep the order of the TgDump they were built from.
+
+    id               int64    message id
+    timestamp        float64  NaN where the message has none
+    timestamp_int    bool     timestamp was an int (JSON) rather than a float (HTML)
+    author           int32    index into names, -1 for None
+    from_id          int32    index into from_ids, -1 for None
+    media            int32    index into media_types
+    has_link         bool     message has a non-empty "links" list
+    reply_count      int32    len(reply_to)
+    reply_ids        int64    every reply_to id of every row, flattened in row
+                              order, as ints (see message_id); -1 for ids
+                              that are not numbers
+    schema           int32    index into schemas, the message's keys in order
+    text             object
+    message_links    object
+    links            object
+    mentions         object
+    reply_to         object
+
+TgColumns is a read-only Mapping from message id to message dict, so the code
+written against TgDump keeps working, but the analyses can use the arrays
+directly.  Message dicts are rebuilt on every access; changing one does not
+change the store.
+
+TgColumns.save writes the store to a cache directory, one .npy file per
+array column and a utf-8 string heap (offsets + bytes) per object column,
+plus meta.json with the format version, a generation id that is new on
+every save, and the interned tables, and the row numbers in id and in
+timestamp order.
+TgColumns.load memory-maps that directory and reads each column the first
+time it is used, so opening a cache costs next to nothing and a --perday run
+never touches the text.  Given the fields a run uses, the message dicts are
+rebuilt with only those, so the columns of the others are never read either.
+"""
+
+CACHE_VERSION = 1
+
+LIST_COLUMNS = ["message_links", "links", "mentions", "reply_to"]
+OBJECT_COLUMNS = ["text"] + LIST_COLUMNS
+FIELDS = set(["id", "from_name", "from_id", "timestamp", "media"] + OBJECT_COLUMNS)
+
+
+def object_column(values):
+    # numpy.array() would turn equal-length lists into a 2d array
+    column = numpy.empty(len(values), dtype=object)
+    for idx, value in enumerate(values):
+        column[idx] = value
+    return column
+
+
+class Interner(object):
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def __call__(self, value):
+        if value not in self.index:
+            self.index[value] = len(self.values)
+            self.values.append(value)
+        return self.index[value]
+
+
+def decode_list(value):
+    return tuple(json.loads(value)) if value else ()
+
+
+def encode_list(value):
+    return json.dumps(list(value)) if value else ""
+
+
+class StringHeap(object):
+    """
+    A column of strings stored as one utf-8 byte array and the offsets of
+    each row in it.  Strings are decoded (and passed through decode, if
+    given) one row at a time as they are read.
+    """
+
+    def __init__(self, offsets, heap, decode=None):
+        self.offsets = offsets
+        self.heap = heap
+        self.decode = decode
+
+    @classmethod
+    def write(cls, path, values, encode=None):
+        encoded = [(encode(value) if encode else value).encode("utf-8") for value in values]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(value) for value in encoded], out=offsets[1:])
+        numpy.save(path + ".offsets.npy", offsets)
+        numpy.save(path + ".heap.npy", numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8))
+
+    @classmethod
+    def load(cls, path, decode=None):
+        return cls(load_array(path + ".offsets.npy"), load_array(path + ".heap.npy"), decode)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def __getitem__(self, row):
+        if isinstance(row, (int, numpy.integer)):
+            value = self.heap[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+            return self.decode(value) if self.decode else value
+        return object_column([self[idx] for idx in numpy.arange(len(self))[row]])
+
+
+def message_id(value):
+    """
+    Returns a reply_to or message_links entry as an int message id, or None.
+    HTML exports give ids as strings.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_array(path):
+    return numpy.load(path, mmap_mode="r")
+
+
+def write_meta(path, meta):
+    """
+    Writes the meta.json of a cache, index or graph directory.  Write it
+    last, after the files it describes, so a half-written directory will
+    not load.
+    """
+    with open(os.path.join(path, "meta.json"), "w") as META:
+        json.dump(meta, META)
+
+
+def read_meta(path, version):
+    """
+    Returns the meta.json of the directory path, or None if there is none
+    or it is not of version.
+    """
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, "r") as META:
+        meta = json.load(META)
+    return meta if meta.get("version") == version else None
+
+
+def fingerprint(messages, fields):
+    """
+    Returns what tells whether an index or graph was built from messages:
+    the generation of a saved TgColumns (or of the segments of a store), or
+    else a hash of the ids and of fields of every message.
+    """
+    if getattr(messages, "generation", None):
+        return messages.generation
+    sha256 = hashlib.sha256()
+    for msg in messages.values():
+        values = [msg.get(field) for field in fields]
+        sha256.update(repr([list(value) if isinstance(value, tuple) else value for value in values]).encode())
+    return sha256.hexdigest()
+
+
+def open_saved(cls, messages, path, fields):
+    """
+    Returns cls (TgSearchIndex or TgGraph) of messages: the one saved in
+    path if it was built from them (see fingerprint), otherwise a new one,
+    which is saved to path.  Without a path it is just built.
+    """
+    if not path:
+        return cls.build(messages)
+    current = fingerprint(messages, fields)
+    saved = cls.load(path)
+    if saved is None or saved.fingerprint != current:
+        saved = cls.build(messages, current)
+        saved.save(path)
+    return saved
+
+
+class CachedColumns(Mapping):
+    """
+    The columns of a cache directory, each loaded on first use.
+    """
+
+    def __init__(self, path, kinds):
+        self.path = path
+        self.kinds = kinds
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            path = os.path.join(self.path, name)
+            kind = self.kinds[name]
+            if kind == "array":
+                self.loaded[name] = load_array(path + ".npy")
+            elif kind == "strings":
+                self.loaded[name] = StringHeap.load(path)
+            elif kind == "lists":
+                self.loaded[name] = StringHeap.load(path, decode_list)
+            else:
+                raise Exception("Unknown column kind {} for {} in {}".format(kind, name, self.path))
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.kinds)
+
+    def __len__(self):
+        return len(self.kinds)
+
+
+class ConcatHeap(object):
+    """
+    Several object columns read as one, without copying them.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.starts = numpy.cumsum([0] + [len(part) for part in parts])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+    def __getitem__(self, row):
+        if isinstance(row, (int, numpy.integer)):
+            part = int(numpy.searchsorted(self.starts, row, side="right")) - 1
+            return self.parts[part][row - int(self.starts[part])]
+        return object_column([self[idx] for idx in numpy.arange(len(self))[row]])
+
+
+class ConcatColumns(Mapping):
+    """
+    The columns of several TgColumns stacked end to end, each built on first
+    use.  Interned columns are translated through the per-part lookup arrays
+    in remaps (whose last entry is what -1 maps to).
+    """
+
+    def __init__(self, parts, remaps):
+        self.parts = parts
+        self.remaps = remaps
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            columns = [part.columns[name] for part in self.parts]
+            if name in self.remaps:
+                columns = [remap[numpy.asarray(column)] for remap, column in zip(self.remaps[name], columns)]
+            if name in OBJECT_COLUMNS:
+                self.loaded[name] = ConcatHeap(columns)
+            else:
+                self.loaded[name] = numpy.concatenate([numpy.asarray(column) for column in columns])
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.parts[0].columns)
+
+    def __len__(self):
+        return len(self.parts[0].columns)
+
+
+class RowHeap(object):
+    """
+    Some rows of an object column, read through their row numbers.
+    """
+
+    def __init__(self, column, rows):
+        self.column = column
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        column = self.column
+        return (column[row] for row in self.rows.tolist())
+
+    def __getitem__(self, row):
+        if isinstance(row, (int, numpy.integer)):
+            return self.column[int(self.rows[row])]
+        return object_column([self.column[idx] for idx in self.rows[row].tolist()])
+
+
+class RowColumns(Mapping):
+    """
+    The columns of a TgColumns cut down to the rows in an ascending array of
+    row numbers, each gathered on first use.  Object columns are not copied
+    but read through the row numbers.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            column = self.columns[name]
+            if name == "reply_ids":
+                keep = numpy.zeros(len(self.columns["id"]), dtype=bool)
+                keep[self.rows] = True
+                self.loaded[name] = numpy.asarray(column)[numpy.repeat(keep, self.columns["reply_count"])]
+            elif name in OBJECT_COLUMNS:
+                self.loaded[name] = RowHeap(column, self.rows)
+            else:
+                self.loaded[name] = numpy.asarray(column)[self.rows]
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+
+class TgColumns(Mapping):
+    def __init__(self, columns, names, from_ids, media_types, schemas, id_order=None, time_order=None, fields=None, generation=None):
+        self.columns = columns
+        self.names = names
+        self.from_ids = from_ids
+        self.media_types = media_types
+        self.schemas = schemas
+        # rows are built with only these fields, None for all of them
+        self.fields = fields
+        # set when the columns are those of a saved cache (see save)
+        self.generation = generation
+        if fields is None:
+            self.row_schemas = schemas
+        else:
+            self.row_schemas = [tuple(field for field in schema if field in fields) for schema in schemas]
+        self._id_order = id_order
+        self._sorted_ids = None
+        self._time_order = time_order
+
+    @property
+    def id_order(self):
+        """
+        Row numbers in message id order.
+        """
+        if self._id_order is None:
+            self._id_order = numpy.argsort(self.columns["id"], kind="stable")
+        return self._id_order
+
+    @property
+    def time_order(self):
+        """
+        Row numbers in timestamp order, the rows without one last.
+        """
+        if self._time_order is None:
+            # argsort puts NaN last
+            self._time_order = numpy.argsort(self.columns["timestamp"], kind="stable")
+        return self._time_order
+
+    @property
+    def sorted_ids(self):
+        if self._sorted_ids is None:
+            self._sorted_ids = numpy.asarray(self.columns["id"])[self.id_order]
+        return self._sorted_ids
+
+    @classmethod
+    def from_dump(cls, messages):
+        """
+        Builds a TgColumns from a TgDump (or any dict of message dicts).
+        """
+        names = Interner()
+        from_ids = Interner()
+        media_types = Interner()
+        schemas = Interner()
+        media_types("")
+        count = len(messages)
+        ids = numpy.empty(count, dtype=numpy.int64)
+        timestamps = numpy.full(count, numpy.nan)
+        timestamp_int = numpy.zeros(count, dtype=bool)
+        author = numpy.empty(count, dtype=numpy.int32)
+        from_id = numpy.empty(count, dtype=numpy.int32)
+        media = numpy.empty(count, dtype=numpy.int32)
+        has_link = numpy.zeros(count, dtype=bool)
+        reply_count = numpy.zeros(count, dtype=numpy.int32)
+        schema = numpy.empty(count, dtype=numpy.int32)
+        reply_ids = []
+        objects = {name: [] for name in OBJECT_COLUMNS}
+        for row, msg in enumerate(messages.values()):
+            ids[row] = msg["id"]
+            timestamp = msg.get("timestamp")
+            if timestamp is not None:
+                timestamps[row] = timestamp
+                timestamp_int[row] = isinstance(timestamp, int)
+            from_name = msg.get("from_name")
+            author[row] = -1 if from_name is None else names(from_name)
+            _from_id = msg.get("from_id")
+            from_id[row] = -1 if _from_id is None else from_ids(_from_id)
+            media[row] = media_types(msg.get("media", ""))
+            has_link[row] = bool(msg.get("links"))
+            replies = msg.get("reply_to") or ()
+            if not isinstance(replies, str):
+                reply_count[row] = len(replies)
+                reply_ids.extend(-1 if _id is None else _id for _id in map(message_id, replies))
+            schema[row] = schemas(tuple(msg.keys()))
+            objects["text"].append(msg.get("text", ""))
+            for name in LIST_COLUMNS:
+                # share one empty tuple between all the empty lists
+                objects[name].append(msg.get(name) or ())
+        for keys in schemas.values:
+            if not FIELDS.issuperset(keys):
+                raise Exception("Unable to store message fields {} in columns".format(set(keys) - FIELDS))
+        columns = {
+            "id": ids,
+            "timestamp": timestamps,
+            "timestamp_int": timestamp_int,
+            "author": author,
+            "from_id": from_id,
+            "media": media,
+            "has_link": has_link,
+            "reply_count": reply_count,
+            "reply_ids": numpy.array(reply_ids, dtype=numpy.int64),
+            "schema": schema,
+        }
+        for name in OBJECT_COLUMNS:
+            columns[name] = object_column(objects[name])
+        return cls(columns, names.values, from_ids.values, media_types.values, schemas.values)
+
+    def save(self, path):
+        """
+        Writes the store to the cache directory path.
+        """
+        os.makedirs(path, exist_ok=True)
+        kinds = {}
+        for name, column in self.columns.items():
+            filename = os.path.join(path, name)
+            if name == "text":
+                StringHeap.write(filename, column)
+                kinds[name] = "strings"
+            elif name in LIST_COLUMNS:
+                StringHeap.write(filename, column, encode_list)
+                kinds[name] = "lists"
+            else:
+                numpy.save(filename + ".npy", numpy.asarray(column))
+                kinds[name] = "array"
+        numpy.save(os.path.join(path, "id_order.npy"), self.id_order)
+        numpy.save(os.path.join(path, "time_order.npy"), self.time_order)
+        self.generation = uuid.uuid4().hex
+        meta = {
+            "version": CACHE_VERSION,
+            "generation": self.generation,
+            "count": len(self),
+            "columns": kinds,
+            "names": self.names,
+            "from_ids": self.from_ids,
+            "media_types": self.media_types,
+            "schemas": [list(schema) for schema in self.schemas],
+        }
+        write_meta(path, meta)
+
+    @classmethod
+    def load(cls, path, fields=None):
+        """
+        Opens a cache directory written by save.  Columns are memory-mapped
+        when first used.  With fields, messages have only those fields.
+        """
+        meta = read_meta(path, CACHE_VERSION)
+        if meta is None:
+            if not os.path.isfile(os.path.join(path, "meta.json")):
+                raise Exception("{} is not a message cache".format(path))
+            raise Exception("Cache {} is not version {}. Rebuild it with --write-cache".format(path, CACHE_VERSION))
+        # caches written before time_order was saved sort on first use
+        time_order_path = os.path.join(path, "time_order.npy")
+        return cls(
+            CachedColumns(path, meta["columns"]),
+            meta["names"],
+            meta["from_ids"],
+            meta["media_types"],
+            [tuple(schema) for schema in meta["schemas"]],
+            id_order=load_array(os.path.join(path, "id_order.npy")),
+            time_order=load_array(time_order_path) if os.path.isfile(time_order_path) else None,
+            fields=fields,
+            # caches written before generations have none, and are hashed
+            generation=meta.get("generation"),
+        )
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Returns one TgColumns holding the rows of every part, in order.
+        Columns are only stacked when they are used, and the object columns
+        never are.  Message ids must not repeat across parts.
+        """
+        tables = {"author": Interner(), "from_id": Interner(), "media": Interner(), "schema": Interner()}
+        remaps = {name: [] for name in tables}
+        for part in parts:
+            for name, values in (("author", part.names), ("from_id", part.from_ids),
+                                 ("media", part.media_types), ("schema", part.schemas)):
+                remap = [tables[name](value) for value in values] + [-1]
+                remaps[name].append(numpy.array(remap, dtype=numpy.int32))
+        generations = [part.generation for part in parts]
+        return cls(
+            ConcatColumns(parts, remaps),
+            tables["author"].values,
+            tables["from_id"].values,
+            tables["media"].values,
+            tables["schema"].values,
+            generation="+".join(generations) if all(generations) else None,
+        )
+
+    def project(self, fields):
+        """
+        Returns the same messages with only fields (None for all of them).
+        The columns are shared, not copied.
+        """
+        return TgColumns(self.columns, self.names, self.from_ids, self.media_types, self.schemas,
+                         id_order=self._id_order, time_order=self._time_order, fields=fields, generation=self.generation)
+
+    def column(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def __iter__(self):
+        return (int(msg_id) for msg_id in self.columns["id"])
+
+    def __contains__(self, msg_id):
+        return self.row_of(msg_id) >= 0
+
+    def __getitem__(self, msg_id):
+        row = self.row_of(msg_id)
+        if row < 0:
+            raise KeyError(msg_id)
+        return self.row(row)
+
+    def row_of(self, msg_id):
+        """
+        Returns the row holding msg_id, or -1.
+        """
+        if not isinstance(msg_id, (int, numpy.integer)) or isinstance(msg_id, bool):
+            return -1
+        pos = numpy.searchsorted(self.sorted_ids, msg_id)
+        if pos < len(self.sorted_ids) and self.sorted_ids[pos] == msg_id:
+            return int(self.id_order[pos])
+        return -1
+
+    def rows_of(self, msg_ids):
+        """
+        Vectorized row_of for an int64 array of ids.
+        """
+        if not len(self.sorted_ids):
+            return numpy.full(len(msg_ids), -1, dtype=numpy.int64)
+        pos = numpy.searchsorted(self.sorted_ids, msg_ids)
+        pos[pos == len(self.sorted_ids)] = 0
+        return numpy.where(self.sorted_ids[pos] == msg_ids, self.id_order[pos], -1)
+
+    def row(self, row):
+        columns = self.columns
+        msg = {}
+        for field in self.row_schemas[columns["schema"][row]]:
+            if field == "id":
+                msg[field] = int(columns["id"][row])
+            elif field == "from_name":
+                msg[field] = self.name(columns["author"][row])
+            elif field == "from_id":
+                _from_id = columns["from_id"][row]
+                msg[field] = None if _from_id < 0 else self.from_ids[_from_id]
+            elif field == "timestamp":
+                timestamp = columns["timestamp"][row]
+                if numpy.isnan(timestamp):
+                    msg[field] = None
+                elif columns["timestamp_int"][row]:
+                    msg[field] = int(timestamp)
+                else:
+                    msg[field] = float(timestamp)
+            elif field == "media":
+                msg[field] = self.media_types[columns["media"][row]]
+            elif field == "text":
+                msg[field] = columns["text"][row]
+            else:
+                msg[field] = list(columns[field][row])
+        return msg
+
+    def values(self):
+        return (self.row(row) for row in range(len(self)))
+
+    def items(self):
+        return ((msg["id"], msg) for msg in self.values())
+
+    def name(self, author):
+        return None if author < 0 else self.names[author]
+
+    def has_link(self, msg_id):
+        row = self.row_of(msg_id)
+        return row >= 0 and bool(self.columns["has_link"][row])
+
+    def allfrom(self, from_name):
+        if from_name not in self.names:
+            return []
+        rows = numpy.flatnonzero(self.columns["author"] == self.names.index(from_name))
+        return [self.row(row) for row in rows]
+
+    def between(self, not_before=None, not_after=None):
+        """
+        Like TgDump.between, returns the messages timestamped from not_before
+        to not_after (inclusive, either can be None), found with two binary
+        searches in time_order.  Columns are only cut down when used.
+        """
+        timestamps = self.columns["timestamp"]
+        order = self.time_order
+        # rows without a timestamp sort last, as if at the end of time
+        key = lambda row: numpy.inf if numpy.isnan(timestamps[row]) else timestamps[row]
+        start = 0 if not_before is None else bisect_left(order, not_before, key=key)
+        if not_after is None:
+            end = bisect_left(order, numpy.inf, key=key)
+        else:
+            end = bisect_right(order, not_after, key=key)
+        rows = numpy.sort(order[start:end])
+        return TgColumns(RowColumns(self.columns, rows), self.names, self.from_ids, self.media_types, self.schemas, fields=self.fields)
+
+    def time_range(self):
+        timestamps = self.columns["timestamp"]
+        if numpy.isnan(timestamps).all():
+            return (None, None)
+        return (float(numpy.nanmin(timestamps)), float(numpy.nanmax(timestamps)))
+
+    def named(self):
+        """
+        Mask of the rows whose from_name is neither None nor "None".
+        """
+        # the trailing False is what author -1 (None) indexes
+        named = numpy.array([name != "None" for name in self.names] + [False], dtype=bool)
+        return named[self.columns["author"]]
+
+    def media_mask(self):
+        has_media = numpy.array([bool(media) for media in self.media_types], dtype=bool)
+        return has_media[self.columns["media"]]
+
+    def reply_targets(self):
+        """
+        Returns (source rows, target rows) for every reply_to id that is in
+        the store, in row order.
+        """
+        sources = numpy.repeat(numpy.arange(len(self)), self.columns["reply_count"])
+        targets = self.rows_of(self.columns["reply_ids"])
+        found = targets >= 0
+        return (sources[found], targets[found])
+
+    def author_counts(self, authors):
+        """
+        Takes an array of author indexes and returns a dict of
+        { name: count }, in order of first appearance like the
+        defaultdict(int) counters built by looping over messages.
+        """
+        if not len(authors):
+            return {}
+        uniq, first, counts = numpy.unique(authors, return_index=True, return_counts=True)
+        order = numpy.argsort(first, kind="stable")
+        return {self.name(uniq[idx]): int(counts[idx]) for idx in order}
+
+    def author_pair_counts(self, rows, columns):
+        """
+        Like author_counts for (row author, column author) pairs, returned as
+        a dict of dicts.
+        """
+        matrix = {}
+        if not len(rows):
+            return matrix
+        width = len(self.names) + 1
+        pairs = (rows.astype(numpy.int64) + 1) * width + (columns.astype(numpy.int64) + 1)
+        uniq, first, counts = numpy.unique(pairs, return_index=True, return_counts=True)
+        for idx in numpy.argsort(first, kind="stable"):
+            row, column = divmod(int(uniq[idx]), width)
+            matrix.setdefault(self.name(row - 1), {})[self.name(column - 1)] = int(counts[idx])
+        return matrix
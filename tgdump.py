@@ -1,19 +1,26 @@
 #!/usr/bin/env python3
 
+import datetime
 import html
 import json
+import multiprocessing
 import os
 import re
+import string
 import sys
 import time
 
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from collections.abc import Mapping, MutableMapping
 from html2text import HTML2Text
+from html2text.utils import escape_md_section
 
 """
 TgDumpParser accepts a path to a single JSON file or a path to a directory
 containing a Telegram dump of HTML message files.  Calling the instance
-returns a dict of messages keyed on message id. For example:
+returns a dict of messages keyed on message id, each a TgMessage (a record
+that reads like a dict).  For example:
 
 {
     id: str: {
@@ -43,10 +50,273 @@ returns a dict of messages keyed on message id. For example:
 
 """
 
+MESSAGE_FIELDS = ("id", "from_name", "from_id", "timestamp", "text", "message_links", "links", "mentions", "media", "reply_to")
+message_fields = frozenset(MESSAGE_FIELDS)
+# what getattr gives for a slot that is not set
+unset = object()
+# every message with the same fields in the same order shares one tuple of them
+message_schemas = {}
+# the fields a message is parsed with whatever else is left out
+REQUIRED_FIELDS = ("id", "timestamp")
+# the fields that come out of a message's text
+TEXT_FIELDS = ("text", "message_links", "links", "mentions")
+
+
+def message_projection(fields):
+    """
+    Returns the set of fields a parser given fields keeps, or None (every
+    field) for None.  Ids and timestamps are always kept, for merging and
+    sanitize_messages, and from_ids are kept with from_names, which merging
+    normalizes by from_id.
+    """
+    if fields is None:
+        return None
+    fields = set(fields) | set(REQUIRED_FIELDS)
+    if "from_name" in fields:
+        fields.add("from_id")
+    if not fields.issubset(MESSAGE_FIELDS):
+        raise Exception("Unknown message fields {}".format(fields - set(MESSAGE_FIELDS)))
+    return fields
+
+
+class TgMessage(MutableMapping):
+    """
+    One message, as a record that costs a fraction of the dict the parsers
+    used to build: the fields are slots, the field names (in the message's
+    own order, which differs between JSON and HTML exports) are one tuple
+    shared by every message with the same fields, author names and ids are
+    interned, and empty lists are all the same empty tuple.
+
+    It is a MutableMapping, so msg["text"], msg.get, "links" in msg, items()
+    and the rest work as on the dicts, and repr() and the JSON encoding (see
+    json_default) are what the dict's were.  Only the fields in
+    MESSAGE_FIELDS can be set.
+
+    The text can be left to be built the first time it is read (see
+    defer_text), for runs that never read it.
+    """
+    __slots__ = ("_keys", "_text_source") + MESSAGE_FIELDS
+
+    def __init__(self, fields=None):
+        self._keys = ()
+        for key, value in (fields or {}).items():
+            self[key] = value
+
+    # every field the message has is a set slot, except deferred text, so
+    # reading one is a getattr rather than a search of the keys.  These are
+    # what the reports spend their time in.
+
+    def __getitem__(self, key):
+        if key in message_fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                if key == "text" and hasattr(self, "_text_source"):
+                    return self.build_text()
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in message_fields:
+            value = getattr(self, key, unset)
+            if value is not unset:
+                return value
+            if key == "text" and hasattr(self, "_text_source"):
+                return self.build_text()
+        return default
+
+    def build_text(self):
+        build, source = self._text_source
+        self.text = build(source)
+        del self._text_source
+        return self.text
+
+    def __getstate__(self):
+        # deferred text is pickled as its source
+        state = {}
+        for name in self.__slots__:
+            value = getattr(self, name, unset)
+            if value is not unset:
+                state[name] = value
+        return (None, state)
+
+    def defer_text(self, build, source):
+        """
+        Makes the text build(source), built the first time it is read and
+        kept from then on.  build has to be a module-level function so that
+        the message can still be pickled; pickles keep the source.
+        """
+        self["text"] = ""
+        del self.text
+        self._text_source = (build, source)
+
+    def __setitem__(self, key, value):
+        if key not in MESSAGE_FIELDS:
+            raise Exception("Unable to store message field {}".format(key))
+        if key == "text" and hasattr(self, "_text_source"):
+            del self._text_source
+        if isinstance(value, list) and not value:
+            value = ()
+        elif isinstance(value, str) and key in ("from_name", "from_id"):
+            value = sys.intern(value)
+        setattr(self, key, value)
+        if key not in self._keys:
+            keys = self._keys + (key,)
+            self._keys = message_schemas.setdefault(keys, keys)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key == "text" and hasattr(self, "_text_source"):
+            del self._text_source
+        else:
+            delattr(self, key)
+        keys = tuple(_key for _key in self._keys if _key != key)
+        self._keys = message_schemas.setdefault(keys, keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def items(self):
+        if hasattr(self, "_text_source"):
+            self.build_text()
+        return [(key, getattr(self, key)) for key in self._keys]
+
+    def values(self):
+        if hasattr(self, "_text_source"):
+            self.build_text()
+        return [getattr(self, key) for key in self._keys]
+
+    def as_dict(self):
+        """
+        The message as the dict the parsers used to build, empty lists and
+        all.
+        """
+        return {key: [] if value == () else value for key, value in self.items()}
+
+    def __eq__(self, other):
+        if isinstance(other, TgMessage):
+            if self._keys != other._keys:
+                return False
+            # texts deferred from the same source are equal unbuilt
+            source = getattr(self, "_text_source", None)
+            if source and source == getattr(other, "_text_source", None):
+                return all(getattr(self, key) == getattr(other, key) for key in self._keys if key != "text")
+            return self.values() == other.values()
+        if isinstance(other, Mapping):
+            return self.as_dict() == dict(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+def json_default(value):
+    """
+    The default for json.dumps (or orjson.dumps) to encode TgMessages with.
+    """
+    if isinstance(value, TgMessage):
+        return dict(value.items())
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+class TgTimeIndex(object):
+    """
+    The ids of a TgDump's messages in timestamp order, for finding the ones
+    in a date range with two binary searches.  Messages without a timestamp
+    are left out.
+    """
+
+    def __init__(self, messages):
+        dated = [(msg["timestamp"], position, msg_id)
+                 for position, (msg_id, msg) in enumerate(messages.items()) if msg.get("timestamp") is not None]
+        dated.sort(key=lambda entry: entry[0])
+        self.timestamps = [entry[0] for entry in dated]
+        self.positions = [entry[1] for entry in dated]
+        self.ids = [entry[2] for entry in dated]
+
+    def between(self, not_before=None, not_after=None):
+        """
+        Returns the ids of the messages timestamped from not_before to
+        not_after (inclusive, either can be None), in the dump's order.
+        """
+        start = 0 if not_before is None else bisect_left(self.timestamps, not_before)
+        end = len(self.timestamps) if not_after is None else bisect_right(self.timestamps, not_after)
+        # dumps are nearly always in time order already, which sorts in one pass
+        found = sorted(zip(self.positions[start:end], self.ids[start:end]))
+        return [msg_id for position, msg_id in found]
+
+
+class TgDumpView(Mapping):
+    """
+    The messages of a TgDump timestamped from not_before to not_after, as
+    returned by TgDump.between.  Nothing is copied: it reads through to the
+    dump, and only holds the ids in range.  It iterates in the dump's order
+    and answers what the reports ask of a TgDump.
+    """
+
+    def __init__(self, dump, ids, not_before=None, not_after=None):
+        self.dump = dump
+        self.ids = ids
+        self.not_before = not_before
+        self.not_after = not_after
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, msg_id):
+        msg = self.dump.get(msg_id)
+        if msg is None or msg.get("timestamp") is None:
+            return False
+        if self.not_before is not None and msg["timestamp"] < self.not_before:
+            return False
+        if self.not_after is not None and msg["timestamp"] > self.not_after:
+            return False
+        return True
+
+    def __getitem__(self, msg_id):
+        if msg_id not in self:
+            raise KeyError(msg_id)
+        return self.dump[msg_id]
+
+    def values(self):
+        dump = self.dump
+        return (dump[msg_id] for msg_id in self.ids)
+
+    def items(self):
+        dump = self.dump
+        return ((msg_id, dump[msg_id]) for msg_id in self.ids)
+
+    def has_link(self, _id):
+        return _id in self and self.dump.has_link(_id)
+
+    def ids_from(self, from_name):
+        return [msg_id for msg_id in self.dump.ids_from(from_name) if msg_id in self]
+
+    def allfrom(self, from_name):
+        return [self.dump[msg_id] for msg_id in self.ids_from(from_name)]
+
+
 class TgDump(dict):
+    # from_name -> [msg_id], in message order.  Built on first use and
+    # dropped by normalize_from_name (and so by merge).  The class attribute
+    # covers dumps unpickled from before the index existed.
+    from_index = None
+    # a TgTimeIndex, built by the first between and dropped by merge
+    time_index = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.from_cache = {}
+        self.from_index = None
+        self.time_index = None
         self.id_map = defaultdict(list)
         self.earliest = 99999999999
         self.latest = 0
@@ -77,10 +347,48 @@ class TgDump(dict):
             return False
         return len(msg["links"]) != 0
 
+    def build_index(self):
+        from_index = defaultdict(list)
+        for msg_id, msg in self.items():
+            from_index[msg.get("from_name")].append(msg_id)
+        self.from_index = dict(from_index)
+
+    def ids_from(self, from_name):
+        if self.from_index is None:
+            self.build_index()
+        return self.from_index.get(from_name, [])
+
     def allfrom(self, from_name):
-        if from_name not in self.from_cache:
-            self.from_cache[from_name] = (msg for msg in self.values() if msg["from_name"] == from_name)
-        return self.from_cache[from_name]
+        return [self[msg_id] for msg_id in self.ids_from(from_name)]
+
+    def select(self, keep):
+        """
+        Returns a new TgDump holding the messages for which keep(msg) is
+        true.  The author index is carried over rather than rebuilt.
+        """
+        selected = TgDump((msg_id, msg) for msg_id, msg in self.items() if keep(msg))
+        if self.from_index is not None:
+            selected.from_index = self.select_index(self.from_index, selected)
+        selected.id_map = self.id_map
+        return selected
+
+    def between(self, not_before=None, not_after=None):
+        """
+        Returns a TgDumpView of the messages timestamped from not_before to
+        not_after (inclusive, either can be None).  The first call sorts
+        the messages by time; after that it is two binary searches.
+        """
+        if self.time_index is None:
+            self.time_index = TgTimeIndex(self)
+        return TgDumpView(self, self.time_index.between(not_before, not_after), not_before, not_after)
+
+    def select_index(self, index, selected):
+        selected_index = {}
+        for key, msg_ids in index.items():
+            msg_ids = [msg_id for msg_id in msg_ids if msg_id in selected]
+            if msg_ids:
+                selected_index[key] = msg_ids
+        return selected_index
 
     def isnull(self, value):
         # the use case here is figuring out if one dump or another has a better value
@@ -92,43 +400,53 @@ class TgDump(dict):
             return True
         return False
 
-    def merge(self, other_tgdump):
+    def merge(self, *other_tgdumps):
         """
-        merge another tg dump into this one.
+        merge other tg dumps into this one.
         only add data, do not lose anything.
-        call this on an older dump with a newer one as its argument.
+        call this on an older dump with newer ones as its arguments,
+        oldest first.
         when in doubt, new dump wins.
+        names are normalized once, after all of the dumps are in.
         """
-        for msg_id, msg in other_tgdump.items():
-            if msg_id not in self:
-                self[msg_id] = msg
+        for other_tgdump in other_tgdumps:
+            # most of an overlapping export is identical to what we already
+            # have, so only field-merge the messages that differ, then add
+            # the ones we have never seen wholesale
+            for msg_id in self.keys() & other_tgdump.keys():
+                ours = self[msg_id]
+                msg = other_tgdump[msg_id]
+                if ours is not msg and ours != msg:
+                    self.merge_message(ours, msg)
+            self.update((msg_id, msg) for msg_id, msg in other_tgdump.items() if msg_id not in self)
+        self.normalize_from_name()
+        self.update_earliest_and_latest()
+        self.time_index = None
+
+    def merge_message(self, ours, msg):
+        for field, value in msg.items():
+            if field not in ours:
+                ours[field] = value
                 continue
-            for field, value in msg.items():
-                if field not in self[msg_id]:
-                    self[msg_id][field] = value
-                    continue
-                if self.isnull(value):
+            if self.isnull(value):
+                continue
+            if self.isnull(ours[field]):
+                ours[field] = value
+            else:
+                if ours[field] == value:
                     continue
-                if self.isnull(self[msg_id][field]):
-                    self[msg_id][field] = value
-                else:
-                    if self[msg_id][field] == value:
+                if field == "from_name":
+                    # always take an updated from_name, this needs to be consistent for the reports
+                    if value == "Deleted Account":
+                        # unless it's not their name any more
                         continue
-                    if field == "from_name":
-                        # always take an updated from_name, this needs to be consistent for the reports
-                        if value == "Deleted Account":
-                            # unless it's not their name any more
-                            continue
-                        self[msg_id]["from_name"] = value
-                    else:
-                        self[msg_id][field] = value
-                        #raise Exception(f"Message id {msg_id} has conflicting values for field {field}. Ours is {self[msg_id][field]}, other is {value}")
-        self.normalize_from_name()
-        self.update_earliest_and_latest()
+                    ours["from_name"] = value
+                else:
+                    ours[field] = value
+                    #raise Exception(f"Message id {msg_id} has conflicting values for field {field}. Ours is {ours[field]}, other is {value}")
 
     def normalize_from_name(self):
-        msg_ids = list(self.keys())
-        msg_ids.sort(key=lambda x: 0 - x)
+        msg_ids = sorted(self.keys(), reverse=True)
         for msg_id in msg_ids:
             msg = self[msg_id]
             if "from_id" not in msg:
@@ -141,6 +459,97 @@ class TgDump(dict):
             # walking through the messages backwards, keep the last not-sucky name
             if names and names[0] and not self.isnull(names[0]) and names[0] != "Deleted Account":
                 msg["from_name"] = names[0]
+        self.from_index = None
+
+class JsonArrayReader(object):
+    """
+    Incrementally decodes the elements of one array-valued key of a top-level
+    JSON object, e.g. the "messages" array of a Telegram result.json, reading
+    the file in chunks instead of loading the whole document.  Iterating the
+    reader yields one decoded element at a time; every other key is decoded
+    and thrown away.
+    """
+
+    ws_re = re.compile(r"\s*")
+
+    def __init__(self, fileobj, key, chunk_size=1 << 20):
+        self.fileobj = fileobj
+        self.key = key
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.found = False
+
+    def __iter__(self):
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.decode()
+            self.expect(":")
+            if key == self.key:
+                self.found = True
+                yield from self.array()
+            else:
+                self.decode()
+            if self.expect(",}") == "}":
+                return
+
+    def array(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(",]") == "]":
+                return
+
+    def fill(self):
+        # read at least as much as we are already holding, so that a value
+        # spanning many chunks is retried a logarithmic number of times
+        chunk = self.fileobj.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = self.ws_re.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise Exception("Expected one of {} in JSON stream, found {}".format(chars, char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # most likely a value cut in half by the end of the buffer
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.buf) or self.buf[end] in ".eE+-":
+                # numbers and literals can be truncated without failing
+                if not self.eof and self.fill():
+                    continue
+            self.pos = end
+            return value
+
 
 class TgJsonParser(object):
     """
@@ -158,48 +567,76 @@ class TgJsonParser(object):
     The HTML dumps do not contain the from_id field, only from_name, but
     the message IDs are consistent. Dumps can be merged by messsage ID.
     I think.
+
+    With streaming=True the "messages" array is decoded one element at a
+    time, so only the normalized messages are ever held in memory.
+
+    With fields, messages only have those fields (see message_projection),
+    and the text entities are not looked at when no field comes from them.
+    With after_id, messages (and actions) with ids up to after_id are
+    skipped before they are normalized.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, streaming=False, fields=None, after_id=None):
         self.filename = filename
+        self.streaming = streaming
+        self.fields = message_projection(fields)
+        self.after_id = after_id
 
     def __call__(self):
         return self.parse()
 
-    def parse(self):
+    def iter_raw_messages(self):
         with open(self.filename, "r") as JSON:
-            data = json.load(JSON)
-        if "messages" not in data:
-            raise Exception("Unable to load json data from {}".format(self.filename))
-        messages = TgDump()
-        actions = []
-        for message in data["messages"]:
-            if "action" in message:
-                actions.append(message)
-            msg = {
-                "id": None,
-                "from_name": None,
-                "from_id": None,
-                "timestamp": None,
-                "text": "",
-                "message_links": [],
-                "links": [],
-                "mentions": [],
-                "media": "",
-                "reply_to": []
-            }
-            msg["id"] = message["id"]
-            if "date_unixtime" in message:
-                msg["timestamp"] = int(message["date_unixtime"])
-                messages.check_timestamp(msg)
-            if "from" in message:
-                msg["from_name"] = message["from"]
-            if "from_id" in message:
-                msg["from_id"] = message["from_id"]
-            if "reply_to_message_id" in message:
-                msg["reply_to"] = [message["reply_to_message_id"]]
-            if "media_type" in message:
-                msg["media"] = message["media_type"]
+            if self.streaming:
+                reader = JsonArrayReader(JSON, "messages")
+                yield from reader
+                if not reader.found:
+                    raise Exception("Unable to load json data from {}".format(self.filename))
+            else:
+                data = json.load(JSON)
+                if "messages" not in data:
+                    raise Exception("Unable to load json data from {}".format(self.filename))
+                yield from data["messages"]
+
+    def iter_parse(self):
+        """
+        Yields (msg, action) for every message in the export, where msg is
+        the normalized TgMessage and action is the raw message if it is
+        a service action (join, leave, ...) and None otherwise.
+        """
+        after_id = self.after_id
+        for message in self.iter_raw_messages():
+            if after_id is not None and message["id"] <= after_id:
+                continue
+            action = message if "action" in message else None
+            yield (self.normalize(message), action)
+
+    def normalize(self, message):
+        msg = {
+            "id": None,
+            "from_name": None,
+            "from_id": None,
+            "timestamp": None,
+            "text": "",
+            "message_links": [],
+            "links": [],
+            "mentions": [],
+            "media": "",
+            "reply_to": []
+        }
+        msg["id"] = message["id"]
+        if "date_unixtime" in message:
+            msg["timestamp"] = int(message["date_unixtime"])
+        if "from" in message:
+            msg["from_name"] = message["from"]
+        if "from_id" in message:
+            msg["from_id"] = message["from_id"]
+        if "reply_to_message_id" in message:
+            msg["reply_to"] = [message["reply_to_message_id"]]
+        if "media_type" in message:
+            msg["media"] = message["media_type"]
+        if self.fields is None or not self.fields.isdisjoint(TEXT_FIELDS):
             text = []
             if isinstance(message["text"], str):
                 text = [message["text"]]
@@ -213,8 +650,20 @@ class TgJsonParser(object):
                             msg["links"].append(entry["text"])
                     else:
                         text.append(entry)
-            msg["text"] = " ".join(text)
+            if self.fields is None or "text" in self.fields:
+                msg["text"] = " ".join(text)
+        if self.fields is not None:
+            msg = {field: value for field, value in msg.items() if field in self.fields}
+        return TgMessage(msg)
 
+    def parse(self):
+        messages = TgDump()
+        actions = []
+        for msg, action in self.iter_parse():
+            if action is not None:
+                actions.append(action)
+            if msg["timestamp"] is not None:
+                messages.check_timestamp(msg)
             messages[msg["id"]] = msg
         self.messages = messages
         self.messages.normalize_from_name()
@@ -225,33 +674,209 @@ In reply to <a href="#go_to_message286750" onclick="return GoToMessage(286750)">
 """
 
 
+class TgTextConverter(object):
+    """
+    Turns the html of a message body into the text a fresh HTML2Text would
+    make of it.  Telegram exports only use a few inline tags (br, bold,
+    italic, code), and for those this replays just the parts of HTML2Text's
+    state machine that they touch, which is much cheaper than setting up a
+    whole HTML2Text document per message.  Anything else (other tags,
+    unusual entities) goes to a new HTML2Text instance so that no state
+    leaks from one message into the next.  Results are cached, since short
+    bodies ("ok", "lol", a lone link) repeat a lot.
+    """
+    token_re = re.compile(r"<(/?)(br|strong|b|em|i|u|code)( ?/)?>|<[a-zA-Z/!?]|&(lt|gt|amp|quot|apos|nbsp);|&|<|[^<&]+")
+    space_re = re.compile(r"\s+")
+    collapse_re = re.compile(r"\s\s|[^\S ]")
+    # escape_md_section only ever touches text with one of these in it
+    escape_re = re.compile(r"[\\.+-]")
+    stressed_re = re.compile(r"[^][(){}\s.!?]")
+    nbsp = "&nbsp_place_holder;"
+
+    def __init__(self, cache_size=100000):
+        self.cache = {}
+        self.cache_size = cache_size
+        self.entities = {}
+        self.fast = 0
+        self.fallbacks = 0
+
+    def __call__(self, text):
+        if text in self.cache:
+            return self.cache[text]
+        result = self.convert(text)
+        if result is None:
+            self.fallbacks += 1
+            result = self.html2text(text)
+        else:
+            self.fast += 1
+        if len(self.cache) < self.cache_size:
+            self.cache[text] = result
+        return result
+
+    def html2text(self, text):
+        parser = HTML2Text()
+        parser.feed(text)
+        return parser.finish()
+
+    def entity(self, name):
+        if name not in self.entities:
+            self.entities[name] = HTML2Text().entityref(name)
+        return self.entities[name]
+
+    def convert(self, text):
+        """
+        Returns what HTML2Text would make of text, or None if text has markup
+        this does not handle.  The names follow HTML2Text's attributes.
+        """
+        out = []
+        start = True
+        space = False
+        last_was_nl = False
+        stressed = False
+        preceding_stressed = False
+        preceding_data = ""
+        current_tag = ""
+        code = False
+        for match in self.token_re.finditer(text):
+            closing, tag, selfclosing, entity = match.groups()
+            if tag:
+                if selfclosing and (closing or tag != "br"):
+                    return None
+                current_tag = tag
+                if tag == "br":
+                    if closing:
+                        continue
+                    data = "  \n"
+                elif tag in ("strong", "b"):
+                    if not closing and preceding_data and preceding_data[-1] == "*":
+                        data = " **"
+                        preceding_data += " "
+                    else:
+                        data = "**"
+                    stressed = stressed or not closing
+                elif tag == "code":
+                    data = "`"
+                    code = not code
+                else:
+                    if not closing and preceding_data and preceding_data[-1] not in string.whitespace and preceding_data[-1] not in string.punctuation:
+                        data = " _"
+                        preceding_data += " "
+                    else:
+                        data = "_"
+                    stressed = stressed or not closing
+            else:
+                data = match.group()
+                if entity:
+                    data = self.entity(entity)
+                elif data[0] in "<&" and len(data) > 1 or data == "&":
+                    return None
+                if stressed:
+                    data = data.strip()
+                    stressed = False
+                    preceding_stressed = True
+                elif preceding_stressed:
+                    if self.stressed_re.match(data[0]) and current_tag != "code":
+                        data = " " + data
+                    preceding_stressed = False
+                if not code and not entity and self.escape_re.search(data):
+                    data = escape_md_section(data)
+                preceding_data = data
+                if self.collapse_re.search(data):
+                    data = self.space_re.sub(" ", data)
+                if data and data[0] == " ":
+                    space = True
+                    data = data[1:]
+                if not data:
+                    continue
+            if start:
+                space = False
+                start = False
+            if space:
+                if not last_was_nl:
+                    out.append(" ")
+                space = False
+            out.append(data)
+            last_was_nl = data[-1] == "\n"
+        out.append("\n")
+        return "".join(out).replace(self.nbsp, " ")
+
+
 class TgHtmlParser(object):
     div_re = re.compile(r'(\w+)="(.*?)"')
     message_link_re = re.compile(r'onclick="return GoToMessage\((.*?)\)"')
     mention_re = re.compile(r'ShowMentionName\(\)">(.*?)</a>')
     href_re = re.compile(r"<a href.*?>(.*?)</a>")
+    # the div lines Telegram writes, parsed without div_re.findall and dict
+    div_attrs_re = re.compile(r'\s*<div class="([^"\n]*)"(?: id="([^"\n]*)")?(?: title="([^"\n]*)")?>\s*')
+    date_re = re.compile(r"(\d\d)\.(\d\d)\.(\d{4}) (\d\d):(\d\d):(\d\d)(?: UTC[+-]\d\d:\d\d)?$")
 
-    def __init__(self, directory):
+    def __init__(self, directory, jobs=1, files=None, lazy_text=False, fields=None, after_id=None):
         self.dump_dir = directory
-        self.html_parser = HTML2Text()
+        self.jobs = jobs or os.cpu_count()
+        # parse only these messages*.html paths instead of the whole directory
+        self.files = files
+        # convert message html to text only when the text is read
+        self.lazy_text = lazy_text
+        # keep only these fields (see message_projection), and only collect
+        # the lines of the multi-line fields they come from
+        self.fields = message_projection(fields)
+        self.collect_fields = set(["text", "media", "reply_to"])
+        if self.fields is not None:
+            self.collect_fields = set(["media", "reply_to"]) & self.fields
+            if not self.fields.isdisjoint(TEXT_FIELDS):
+                self.collect_fields.add("text")
+        # skip the messages with ids up to this one
+        self.after_id = after_id
+        self.html_to_text = TgTextConverter()
 
     def __call__(self):
         return self.parse()
 
+    def message_files(self, dump_dir):
+        """
+        Returns the paths of the messages*.html files in dump_dir in export
+        order (messages.html, messages2.html, ..., messages10.html).
+        """
+        def export_order(filename):
+            digits = filename[len("messages"):-len(".html")]
+            return int(digits) if digits.isdigit() else 1
+        filenames = [f for f in os.listdir(dump_dir) if f.startswith("messages") and f.endswith(".html")]
+        filenames.sort(key=export_order)
+        return [os.path.join(dump_dir, f) for f in filenames]
+
+    def parse_file(self, path):
+        with open(path, "r") as MESSAGES:
+            return self.parse_messages(MESSAGES)
+
     def parse(self, dump_dir=None):
         dump_dir = dump_dir or self.dump_dir
         messages = TgDump()
         if dump_dir:
-            for filename in os.listdir(dump_dir):
-                if filename.startswith("messages") and filename.endswith(".html"):
-                    with open(os.path.join(dump_dir, filename), "r") as MESSAGES:
-                        messages.update(self.parse_messages(MESSAGES.readlines()))
+            files = self.files if self.files is not None else self.message_files(dump_dir)
+            if self.jobs > 1 and len(files) > 1:
+                with multiprocessing.Pool(min(self.jobs, len(files))) as pool:
+                    results = pool.starmap(_parse_html_file, [(path, self.lazy_text, self.fields, self.after_id) for path in files])
+            else:
+                results = map(self.parse_file, files)
+            parsed = {}
+            for result in results:
+                parsed.update(result)
+            messages = TgDump(sorted(parsed.items()))
             self.messages = messages
         return (messages, [])
 
     def parse_div_line(self, line):
         if not line:
             return {}
+        match = self.div_attrs_re.fullmatch(line)
+        if match:
+            div_class, div_id, title = match.groups()
+            div = {"class": div_class}
+            if div_id is not None:
+                div["id"] = div_id
+            if title is not None:
+                div["title"] = title
+            return div
         matches = self.div_re.findall(line)
         return dict(matches)
 
@@ -269,32 +894,86 @@ class TgHtmlParser(object):
             if "ShowMentionName" in msg["text"]:
                 matches = self.mention_re.findall(msg["text"])
                 msg["mentions"] = list(matches)
-            msg["text"] = self.href_re.sub("<1>", msg["text"])
-            self.html_parser.feed(msg["text"])
-            try:
-                msg["text"] = self.html_parser.finish().strip()
-            except Exception as e:
-                print("Unable to parse html {}".format(e))
+            if not self.lazy_text and (self.fields is None or "text" in self.fields):
+                msg["text"] = self.message_text(msg["text"])
         return msg
 
-    def parse_messages(self, lines):
-        messages = {}
+    def message_text(self, text):
+        """
+        Returns the plain text of a message's html.
+        """
+        text = self.href_re.sub("<1>", text)
+        try:
+            text = self.html_to_text(text).strip()
+        except Exception as e:
+            print("Unable to parse html {}".format(e))
+        return text
 
-        # eat everything before the html body
-        while '<div class="body">' not in lines[0]:
-            lines.pop(0)
+    def parse_timestamp(self, title):
+        # time.strptime is the slowest part of the scan, so take the common
+        # "16.08.2022 13:36:42 UTC-07:00" shape apart by hand.  Like the
+        # strptime version, the UTC offset is ignored by mktime.
+        match = self.date_re.match(title)
+        try:
+            if match:
+                day, month, year, hour, minute, second = map(int, match.groups())
+                # out of range fields are an error for strptime, not for mktime
+                datetime.date(year, month, day)
+                if hour > 23 or minute > 59 or second > 61:
+                    return None
+                return time.mktime((year, month, day, hour, minute, second, 0, 1, -1))
+            if 'UTC' in title:
+                return time.mktime(time.strptime(title, '%d.%m.%Y %H:%M:%S UTC%z'))
+            return time.mktime(time.strptime(title, '%d.%m.%Y %H:%M:%S'))
+        except:
+            return None
 
-        msg = {
-            "id": None,
-            "from_name": None,
+    def new_message(self, from_name=None):
+        return {
+            "from_name": from_name,
             "timestamp": None,
             "text": "",
             "message_links": [],
             "mentions": [],
             "media": "",
-            "reply_to": []
+            "reply_to": "",
+            "id": None
         }
 
+    def finish_message(self, msg, chunks, messages):
+        for field, lines in chunks.items():
+            msg[field] = "".join(lines)
+        msg = self.post_process(msg)
+        if self.fields is not None:
+            msg = {field: value for field, value in msg.items() if field in self.fields}
+        msg = TgMessage(msg)
+        if self.lazy_text and msg.get("text"):
+            msg.defer_text(_html_message_text, msg["text"])
+        messages[msg["id"]] = msg
+
+    def parse_messages(self, lines):
+        """
+        Scans the lines of one messages*.html file in a single pass.  lines
+        can be any iterable of lines, usually the open file itself, so the
+        file is never held in memory as a list.  Multi-line fields (text,
+        media, reply_to) are collected as lists of lines and joined once per
+        message.  Skipped messages (see after_id) are scanned for nothing but
+        their from_name, which the next message can inherit.
+        """
+        messages = {}
+        lines = iter(lines)
+        after_id = self.after_id
+        collect = self.collect_fields
+
+        # eat everything before the html body
+        for line in lines:
+            if '<div class="body">' in line:
+                break
+
+        msg = self.new_message()
+        chunks = {}
+        collecting = collect
+
         # use 'target' to track what field we want to fill in with subsequent lines
         target = None
 
@@ -305,47 +984,32 @@ class TgHtmlParser(object):
             elif "<div" in line:
                 div = self.parse_div_line(line)
                 target = None
-                if div["class"].startswith("message default clearfix"):
+                div_class = div["class"]
+                if div_class.startswith("message default clearfix"):
                     # new message.  if we were building an old message, save it.
                     wait_for_new = False
-                    if msg["id"]:
-                        if msg["timestamp"] is None:
-                            msg["timestamp"] = messages[-1]["timestamp"] # HACK
-                        messages[msg["id"]] = self.post_process(msg)
+                    if msg["id"] and collecting is collect:
+                        self.finish_message(msg, chunks, messages)
                     from_name = None
-                    if div["class"].endswith("joined"):
+                    if div_class.endswith("joined"):
                         # class "message default clearfix joined" inherits
                         # from_name from the preceding message
                         from_name = msg["from_name"]
-                    msg = {
-                        "from_name": from_name,
-                        "timestamp": None,
-                        "text": "",
-                        "message_links": [],
-                        "mentions": [],
-                        "media": "",
-                        "reply_to": []
-                    }
+                    msg = self.new_message(from_name)
+                    chunks = {}
                     msg["id"] = int(div["id"].replace("message",""))
-                elif div["class"] == "forwarded body":
-                    target = None
+                    collecting = collect if after_id is None or msg["id"] > after_id else ()
+                elif div_class == "forwarded body":
                     wait_for_new = True
-                elif div["class"] == "from_name":
+                elif div_class == "from_name":
                     target = "from_name"
-                elif div["class"] == "text":
+                elif div_class == "text":
                     target = "text"
-                elif div["class"] == "pull_right date details":
-                    msg["timestamp"] = div["title"]
-                    try:
-                        if 'UTC' in msg["timestamp"]:
-                            msg["timestamp"] = time.mktime(time.strptime(msg["timestamp"], '%d.%m.%Y %H:%M:%S UTC%z'))
-                        else:
-                            msg["timestamp"] = time.mktime(time.strptime(msg["timestamp"], '%d.%m.%Y %H:%M:%S'))
-                    except:
-                        msg["timestamp"] = None
-                elif div["class"] == "media_wrap clearfix":
+                elif div_class == "pull_right date details" and collecting is collect:
+                    msg["timestamp"] = self.parse_timestamp(div["title"])
+                elif div_class == "media_wrap clearfix":
                     target = "media"
-                elif div["class"] == "reply_to details":
+                elif div_class == "reply_to details":
                     target = "reply_to"
             elif wait_for_new:
                 continue
@@ -359,24 +1023,50 @@ class TgHtmlParser(object):
                     except:
                         msg[target] = line.strip()
                     target = None
-                else:
-                    msg[target] = msg[target] + line
+                elif target in chunks:
+                    chunks[target].append(line)
+                elif target in collecting:
+                    chunks[target] = [line]
 
-        if msg["id"]:
-            if msg["timestamp"] is None:
-                msg["timestamp"] = messages[-1]["timestamp"] # HACK
-            messages[msg["id"]] = self.post_process(msg)
+        if msg["id"] and collecting is collect:
+            self.finish_message(msg, chunks, messages)
         return messages
 
+_worker_parser = None
+
+def _parse_html_file(path, lazy_text=False, fields=None, after_id=None):
+    """
+    Process pool worker for TgHtmlParser.parse.  Each worker process gets its
+    own TgHtmlParser (and so its own TgTextConverter cache).
+    """
+    global _worker_parser
+    if _worker_parser is None:
+        _worker_parser = TgHtmlParser(None, lazy_text=lazy_text, fields=fields, after_id=after_id)
+    return _worker_parser.parse_file(path)
+
+_text_parser = None
+
+def _html_message_text(text):
+    """
+    Builds the deferred text of a message parsed with lazy_text, with a
+    TgHtmlParser (and TgTextConverter cache) shared by every message.
+    """
+    global _text_parser
+    if _text_parser is None:
+        _text_parser = TgHtmlParser(None)
+    return _text_parser.message_text(text)
+
 class TgDumpParser(object):
-    def __init__(self, dump):
+    def __init__(self, dump, streaming=False, jobs=1, files=None, interpolate=False, lazy_text=False, fields=None, after_id=None):
         self.parser = None
         if os.path.isdir(dump):
-            self.parser = TgHtmlParser(dump)
+            self.parser = TgHtmlParser(dump, jobs=jobs, files=files, lazy_text=lazy_text, fields=fields, after_id=after_id)
         else:
-            self.parser = TgJsonParser(dump)
+            # joining a JSON message's text costs less than deferring it
+            self.parser = TgJsonParser(dump, streaming=streaming, fields=fields, after_id=after_id)
         self.messages = TgDump()
         self.actions = []
+        self.interpolate = interpolate
 
     def __call__(self):
         self.messages, self.actions = self.parser()
@@ -384,14 +1074,35 @@ class TgDumpParser(object):
         return (self.messages, self.actions)
 
     def sanitize_messages(self):
-        for msg_id, msg in self.messages.items():
-            if "timestamp" not in msg or not msg["timestamp"]:
-                _id = msg_id - 1
-                while _id in self.messages:
-                    if "timestamp" in self.messages[_id] and self.messages[_id]["timestamp"]:
-                        msg["timestamp"] = self.messages[_id]["timestamp"]
-                        break
-                    _id -= 1
+        """
+        Fills in missing timestamps in one pass over the ids in order.  A
+        message without a timestamp gets the one from the message before it,
+        or with interpolate, a timestamp spread evenly by id between the known
+        ones on either side.  Messages before the first known timestamp are
+        left alone.
+        """
+        previous = None
+        missing = []
+        for msg_id in sorted(self.messages):
+            msg = self.messages[msg_id]
+            if msg.get("timestamp"):
+                if missing and self.interpolate:
+                    self.interpolate_timestamps(previous, missing, msg)
+                previous = msg
+                missing = []
+            elif previous is not None:
+                if self.interpolate:
+                    missing.append(msg)
+                else:
+                    msg["timestamp"] = previous["timestamp"]
+        for msg in missing:
+            msg["timestamp"] = previous["timestamp"]
+
+    def interpolate_timestamps(self, before, missing, after):
+        span = after["id"] - before["id"]
+        elapsed = after["timestamp"] - before["timestamp"]
+        for msg in missing:
+            msg["timestamp"] = before["timestamp"] + elapsed * (msg["id"] - before["id"]) / span
 
 
 if __name__ == "__main__":
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
+import gzip
+import heapq
 import html
+import io
 import json
+import multiprocessing
 import numpy
 import os
 import pickle
@@ -10,14 +14,23 @@ import re
 import sys
 import time
 
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from contextlib import nullcontext
 from datetime import datetime
 from emoji import is_emoji
-from functools import cache
+from functools import cache, lru_cache
 from html2text import HTML2Text
+from itertools import chain, combinations, islice, repeat
+from operator import itemgetter
 from PIL import Image
-from tgdump import TgDumpParser, TgDump
+from tgcolumns import TgColumns, message_id
+from tgdump import TgDumpParser, TgDump, json_default, message_projection
+from tggraph import EDGES, TgGraph
+from tgsearch import TgSearchIndex
+from tgstore import TgStore
+from tgthreads import TgThreads
 from wordcloud import WordCloud, STOPWORDS, ImageColorGenerator
+from wordcloud.tokenization import process_tokens, score as collocation_score
 
 """
 {'from_name': 'c0ldbru',
@@ -127,11 +140,19 @@ def top_n(dct, n):
     Takes a dict and a count.
     Returns a sorted list of tuples of the top n entries in
     the dict, where the sorting key is the dict value.
+    Ties are ordered as a stable sort of the whole dict would order
+    them, so among equal values the later entries make the cut.
     '''
-    sorted_list_of_tuples = list(filter(lambda x: x[0] != "Deleted Account", sorted(dct.items(), key = lambda foo: foo[1])))
-    if n == 1:
-        return [sorted_list_of_tuples[-1]]
-    return sorted_list_of_tuples[-1 * n :]
+    if n < 1:
+        sorted_list_of_tuples = list(filter(lambda x: x[0] != "Deleted Account", sorted(dct.items(), key = lambda foo: foo[1])))
+        return sorted_list_of_tuples[-1 * n :]
+    # nlargest keeps the first of equal values, so feed it the dict backwards.
+    # "Deleted Account" can only be in there once, so ask for one spare
+    # rather than filtering every item.
+    largest = heapq.nlargest(n + 1, reversed(dct.items()), key=itemgetter(1))
+    largest = [item for item in largest if item[0] != "Deleted Account"][:n]
+    largest.reverse()
+    return largest
 
 def find_replied_to(messages, from_name):
     '''
@@ -156,6 +177,8 @@ def pretty_time(unixtime):
 max_time = 9999999999999999999999
 min_time = -9999999999999999999999
 def tg_time_range(messages):
+    if isinstance(messages, TgColumns):
+        return messages.time_range()
     msgs = iter(messages.items())
     _id, first = next(msgs)
     earliest = first["timestamp"]
@@ -169,42 +192,197 @@ def tg_time_range(messages):
     )
 
 
-def tg_per_day(messages_dict):
-    messages = list(messages_dict.values())
-    messages.sort(key = lambda x: x["timestamp"])
-    results = [] 
-    earliest, latest = (messages[0]["timestamp"], messages[-1]["timestamp"])
-    day = earliest - earliest % 86400 + 86400
-    talkers = {}
-    unique_talkers = set()
-    for message in messages:
-        if message["timestamp"] > day:
-            results.append((day, talkers))
-            day += 86400
-            talkers = {}
-        name = message["from_name"]
-        unique_talkers.add(name)
-        if name not in talkers:
-            talkers[name] = 0
-        talkers[name] += 1
-    results.append((day, talkers))
-    
-    messages_total = 0
-    daily_talkers_total = 0
-    for idx, (day, talkers) in enumerate(results):
-        messages_count = sum(talkers.values())
-        messages_total += messages_count
-        talkers_count = len(talkers)
-        daily_talkers_total += talkers_count
-        print(f"Day {idx}, {messages_count} messages from {talkers_count} talkers")
+# bucket size and the epoch time of one bucket boundary; 1970-01-01 was a
+# Thursday, so weeks start on Monday 1970-01-05
+activity_buckets = {
+    "hour": (3600, 0),
+    "day": (86400, 0),
+    "week": (7 * 86400, 4 * 86400),
+}
 
-    print("Total messages: {}".format(len(messages)))
+def activity_arrays(messages):
+    '''
+    Returns (timestamps, authors, names) for a dict of tg messages:
+    a float array of timestamps (NaN where missing), an int array of
+    indexes into names (-1 for None) and the list of names.
+    '''
+    if isinstance(messages, TgColumns):
+        return (messages.column("timestamp"), messages.column("author"), messages.names)
+    names = []
+    name_index = {}
+    timestamps = numpy.full(len(messages), numpy.nan)
+    authors = numpy.empty(len(messages), dtype=numpy.int64)
+    for row, msg in enumerate(messages.values()):
+        if msg.get("timestamp") is not None:
+            timestamps[row] = msg["timestamp"]
+        name = msg.get("from_name")
+        if name is None:
+            authors[row] = -1
+        else:
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(name)
+            authors[row] = name_index[name]
+    return (timestamps, authors, names)
+
+def tg_per_day(messages_dict, bucket="day"):
+    '''
+    Prints the number of messages and distinct talkers in every hour, day
+    or week between the first and the last message, including the empty
+    ones.
+    '''
+    size, boundary = activity_buckets[bucket]
+    timestamps, authors, names = activity_arrays(messages_dict)
+    dated = ~numpy.isnan(timestamps)
+    timestamps = timestamps[dated]
+    authors = authors[dated].astype(numpy.int64)
+    if not len(timestamps):
+        print("No timestamped messages")
+        return
+    earliest, latest = (timestamps.min(), timestamps.max())
+
+    buckets = numpy.floor((timestamps - boundary) / size).astype(numpy.int64)
+    buckets -= buckets.min()
+    count = int(buckets.max()) + 1
+    messages_per_bucket = numpy.bincount(buckets, minlength=count)
+    # one entry per distinct (bucket, talker); None is a talker like any other
+    width = len(names) + 1
+    talker_buckets = numpy.unique(buckets * width + authors + 1) // width
+    talkers_per_bucket = numpy.bincount(talker_buckets, minlength=count)
+
+    for idx in range(count):
+        print(f"{bucket.capitalize()} {idx}, {messages_per_bucket[idx]} messages from {talkers_per_bucket[idx]} talkers")
+
+    # collect the names in time order, so the set prints as it always has
+    order = numpy.argsort(timestamps, kind="stable")
+    seen, first = numpy.unique(authors[order], return_index=True)
+    unique_talkers = set(None if seen[idx] < 0 else names[seen[idx]] for idx in numpy.argsort(first))
+
+    print("Total messages: {}".format(len(messages_dict)))
     print("Between {} and {}".format(pretty_time(earliest), pretty_time(latest)))
     print(f"Total unique talkers: {len(unique_talkers)}")
-    print(f"Mean talkers per day: {daily_talkers_total / len(results):.1f}")
+    print(f"Mean talkers per {bucket}: {talkers_per_bucket.sum() / count:.1f}")
     print(f"Unique talkers: {unique_talkers}")
 
 
+class TgAggregator(object):
+    '''
+    Computes any number of counters over a dict of tg messages in a single
+    pass.
+
+    A counter is a function taking (msg, messages) and returning a sequence
+    of keys to count for that message (usually empty or a one-tuple of a
+    name).  A matrix counter returns (row, column) pairs instead, and is
+    counted into a dict of dicts.  Add a counter for a new report section
+    rather than another loop over the messages.
+
+    A counter can also be given a columnar version, which takes a TgColumns
+    and returns the finished counts using array operations.  When every
+    counter has one, a TgColumns is counted without building any rows.
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.matrix_counters = {}
+        self.columnar_counters = {}
+        self.counts = {}
+        self.matrices = {}
+
+    def add_counter(self, name, keys, columnar=None):
+        self.counters[name] = keys
+        if columnar:
+            self.columnar_counters[name] = columnar
+        return self
+
+    def add_matrix(self, name, pairs, columnar=None):
+        self.matrix_counters[name] = pairs
+        if columnar:
+            self.columnar_counters[name] = columnar
+        return self
+
+    def run(self, messages):
+        if isinstance(messages, TgColumns) and \
+                all(name in self.columnar_counters for name in list(self.counters) + list(self.matrix_counters)):
+            self.counts = {name: self.columnar_counters[name](messages) for name in self.counters}
+            self.matrices = {name: self.columnar_counters[name](messages) for name in self.matrix_counters}
+            return self
+        counts = {name: defaultdict(int) for name in self.counters}
+        matrices = {name: defaultdict(lambda: defaultdict(int)) for name in self.matrix_counters}
+        counters = [(counts[name], keys) for name, keys in self.counters.items()]
+        matrix_counters = [(matrices[name], pairs) for name, pairs in self.matrix_counters.items()]
+        for msg in messages.values():
+            for counter, keys in counters:
+                for key in keys(msg, messages):
+                    counter[key] += 1
+            for matrix, pairs in matrix_counters:
+                for row, column in pairs(msg, messages):
+                    matrix[row][column] += 1
+        self.counts = counts
+        self.matrices = matrices
+        return self
+
+
+def count_talkers(msg, messages):
+    if msg["from_name"] in [None, "None"]:
+        return ()
+    return (msg["from_name"],)
+
+def count_shitposters(msg, messages):
+    if msg["from_name"] in [None, "None"] or not msg.get("media"):
+        return ()
+    return (msg["from_name"],)
+
+def count_repliers(msg, messages):
+    if not msg["reply_to"]:
+        return ()
+    return (msg["from_name"],)
+
+def count_replied_to(msg, messages):
+    return [messages[_id]["from_name"] for _id in map(message_id, msg["reply_to"]) if _id in messages]
+
+def count_link_posters(msg, messages):
+    if not msg.get("links"):
+        return ()
+    return (msg["from_name"],)
+
+def count_replies(msg, messages):
+    '''
+    Matrix counter of replier -> replied to name, i.e. find_replied_to
+    for every name at once.
+    '''
+    return [(msg["from_name"], messages[_id]["from_name"]) for _id in map(message_id, msg["reply_to"]) if _id in messages]
+
+def columnar_talkers(columns):
+    return columns.author_counts(columns.column("author")[columns.named()])
+
+def columnar_shitposters(columns):
+    return columns.author_counts(columns.column("author")[columns.named() & columns.media_mask()])
+
+def columnar_repliers(columns):
+    return columns.author_counts(columns.column("author")[columns.column("reply_count") > 0])
+
+def columnar_replied_to(columns):
+    sources, targets = columns.reply_targets()
+    return columns.author_counts(columns.column("author")[targets])
+
+def columnar_link_posters(columns):
+    return columns.author_counts(columns.column("author")[columns.column("has_link")])
+
+def columnar_replies(columns):
+    sources, targets = columns.reply_targets()
+    author = columns.column("author")
+    return columns.author_pair_counts(author[sources], author[targets])
+
+def report_aggregator():
+    return TgAggregator() \
+        .add_counter("talkers", count_talkers, columnar_talkers) \
+        .add_counter("repliers", count_repliers, columnar_repliers) \
+        .add_counter("replied_to", count_replied_to, columnar_replied_to) \
+        .add_counter("links", count_link_posters, columnar_link_posters) \
+        .add_counter("shitposters", count_shitposters, columnar_shitposters) \
+        .add_matrix("replies", count_replies, columnar_replies)
+
+
 def tg_report(messages, args):
     '''
     Takes a dict of tg messages (key is the message id as a string,
@@ -218,22 +396,15 @@ def tg_report(messages, args):
     print("Total messages: {}".format(len(messages)))
     print("Between {} and {}".format(*list(map(pretty_time, tg_time_range(messages)))))
 
+    report = report_aggregator().run(messages)
+    counts = report.counts
+
     ##### Top talkers #####
 
     print()
     print("Top talkers:")
 
-    talkers = defaultdict(int)
-    shitposters = defaultdict(int)
-
-    for msg in messages.values():
-        if msg["from_name"] in [None, "None"]:
-            continue
-        talkers[msg["from_name"]] += 1
-        if "media" in msg and msg["media"]:
-            shitposters[msg["from_name"]] += 1
-
-    for talker in top_n(talkers, args.topn):
+    for talker in top_n(counts["talkers"], args.topn):
         print("{}\t{}".format(talker[1], talker[0]))
 
 
@@ -242,13 +413,8 @@ def tg_report(messages, args):
     print()
     print("Top repliers to messages:")
 
-    repliers = defaultdict(int)
-    for msg in messages.values():
-        if msg["reply_to"]:
-            repliers[msg["from_name"]] += 1
-
-    for replier in top_n(repliers, args.topn):
-        repliees = top_n(find_replied_to(messages, replier[0]), args.topn)
+    for replier in top_n(counts["repliers"], args.topn):
+        repliees = top_n(report.matrices["replies"].get(replier[0], {}), args.topn)
         replyee = repliees[-1]
         print("{}\t{} (most replies was {} to {})".format(
             replier[1],
@@ -262,14 +428,7 @@ def tg_report(messages, args):
     print()
     print("Top people replied to:")
 
-    replied_to = defaultdict(int)
-
-    for msg in messages.values():
-        for replied_to_message in msg["reply_to"]:
-            if replied_to_message in messages:
-                replied_to[messages[replied_to_message]["from_name"]] += 1
-
-    for replyee in top_n(replied_to, args.topn):
+    for replyee in top_n(counts["replied_to"], args.topn):
         print("{}\t{}".format(replyee[1], replyee[0]))
 
 
@@ -278,12 +437,7 @@ def tg_report(messages, args):
     print()
     print("Top link posters:")
 
-    links = defaultdict(int)
-    for _id, msg in messages.items():
-        if messages.has_link(_id):
-            links[msg["from_name"]] += 1
-
-    for linkposter in top_n(links, args.topn):
+    for linkposter in top_n(counts["links"], args.topn):
         print("{}\t{}".format(linkposter[1], linkposter[0]))
 
 
@@ -292,16 +446,213 @@ def tg_report(messages, args):
     print()
     print("Top shitposters:")
 
-    for shitposter in top_n(shitposters, args.topn):
+    for shitposter in top_n(counts["shitposters"], args.topn):
         print("{}\t{}".format(shitposter[1], shitposter[0]))
 
 
-def tg_word_cloud(messages, args, words=None):
-    html_tag_re = re.compile(r"<.*?>")
-    html_escape_re = re.compile(r"&.*?;")
+html_tag_re = re.compile(r"<.*?>")
+html_escape_re = re.compile(r"&.*?;")
+wc_punctuation = ",.:;!()&@/?=+"
+# WordCloud.process_text's default tokenizer
+wc_token_re = re.compile(r"\w[\w']*")
 
-    punctuation = ",.:;!()&@/?=+"
+def wc_word(word, excluded_words):
+    '''
+    Returns word cleaned up for the word cloud, or None if it does not
+    belong in it.
+    '''
+    word = word.strip(wc_punctuation).replace('’', '\'')
+    if word and word.lower() not in excluded_words and not is_emoji(word) and "://" not in word:
+        return word
+    return None
 
+def wc_word_classifier(excluded_words, cache_size=100000):
+    '''
+    Returns wc_word for excluded_words, memoized on the raw word.  Chat
+    vocabulary is small next to the number of words written, so nearly
+    every word has been seen before.  At most cache_size words are kept,
+    least recently used first out.
+    '''
+    @lru_cache(maxsize=cache_size)
+    def classify(word):
+        return wc_word(word, excluded_words)
+    return classify
+
+def wc_words(texts, classify):
+    '''
+    Yields the words of texts that belong in the word cloud, one at a time,
+    as cleaned up by classify (see wc_word_classifier).
+    '''
+    for text in texts:
+        if not text:
+            continue
+        for word in html_escape_re.sub("", html_tag_re.sub("", text)).split():
+            word = classify(word)
+            if word:
+                yield word
+
+def wc_tokens(word):
+    '''
+    Returns the tokens WordCloud.process_text makes of a word.
+    '''
+    tokens = []
+    for token in wc_token_re.findall(word):
+        if token.lower().endswith("'s"):
+            token = token[:-2]
+        if not token.isdigit():
+            tokens.append(token)
+    return tokens
+
+def wc_stopwords(wc):
+    return set(word.lower() for word in wc.stopwords)
+
+def wc_count(words, stopwords, collocations):
+    '''
+    Counts a stream of words for wc_frequencies.  Returns (counts, unigrams,
+    bigrams, ends): the words, and if collocations, the WordCloud tokens that
+    are not stopwords and the pairs of them that follow each other.  ends is
+    the first and last token (None for a stopword), or None if there were no
+    tokens, so that wc_merge can pair up tokens across streams.
+    '''
+    counts = Counter()
+    unigrams = Counter()
+    bigrams = Counter()
+    first = False
+    previous = None
+    # the tokens of each distinct word, with None for stopwords
+    tokens_of = {}
+    for word in words:
+        counts[word] += 1
+        if not collocations:
+            continue
+        tokens = tokens_of.get(word)
+        if tokens is None:
+            tokens = tokens_of[word] = [None if token.lower() in stopwords else token for token in wc_tokens(word)]
+        for token in tokens:
+            if first is False:
+                first = token
+            if token is None:
+                previous = None
+                continue
+            unigrams[token] += 1
+            if previous is not None:
+                bigrams[previous + " " + token] += 1
+            previous = token
+    ends = None if first is False else (first, previous)
+    return (counts, unigrams, bigrams, ends)
+
+def wc_merge(parts):
+    '''
+    Adds up the wc_count results of consecutive streams of words, in order,
+    as if they had been counted as one.
+    '''
+    counts = Counter()
+    unigrams = Counter()
+    bigrams = Counter()
+    previous = None
+    for _counts, _unigrams, _bigrams, ends in parts:
+        counts.update(_counts)
+        unigrams.update(_unigrams)
+        if ends:
+            first, last = ends
+            if previous is not None and first is not None:
+                bigrams[previous + " " + first] += 1
+            previous = last
+        bigrams.update(_bigrams)
+    return (counts, unigrams, bigrams, None)
+
+def wc_frequencies(words, wc, counted=None):
+    '''
+    Takes a stream of words and a WordCloud.
+    Returns (word counts, frequencies), where frequencies are what
+    wc.process_text would make of ' '.join(words).  Neither the joined text
+    nor a list of the words is ever built, so memory grows with the
+    vocabulary (and with the distinct word pairs, if wc.collocations).
+    counted is wc_count's result for words, if they were counted already.
+    '''
+    stopwords = wc_stopwords(wc)
+    counts, unigrams, bigrams, _ = counted or wc_count(words, stopwords, wc.collocations)
+    if not wc.collocations:
+        for word, count in counts.items():
+            for token in wc_tokens(word):
+                if token.lower() not in stopwords:
+                    unigrams[token] += count
+
+    # process_tokens counts a list of words; hand it each distinct one as
+    # often as it was seen, in order of first appearance like the list had
+    expand = lambda counter: chain.from_iterable(map(repeat, counter.keys(), counter.values()))
+    frequencies, standard_form = process_tokens(expand(unigrams), wc.normalize_plurals)
+    if not wc.collocations:
+        return (counts, frequencies)
+
+    # the rest of wordcloud.tokenization.unigrams_and_bigrams
+    n_words = sum(unigrams.values())
+    bigram_counts, _ = process_tokens(expand(bigrams), wc.normalize_plurals)
+    unigram_counts = frequencies.copy()
+    for bigram, count in bigram_counts.items():
+        word1, word2 = bigram.split(" ")
+        word1 = standard_form[word1.lower()]
+        word2 = standard_form[word2.lower()]
+        if collocation_score(count, unigram_counts[word1], unigram_counts[word2], n_words) > wc.collocation_threshold:
+            frequencies[word1] -= count
+            frequencies[word2] -= count
+            frequencies[bigram] = count
+    for word, count in list(frequencies.items()):
+        if count <= 0:
+            del frequencies[word]
+    return (counts, frequencies)
+
+# classify, stopwords and collocations of a wc_count_parallel worker
+_wc_worker = None
+
+def _wc_init_worker(excluded_words, cache_size, stopwords, collocations):
+    global _wc_worker
+    _wc_worker = (wc_word_classifier(excluded_words, cache_size), stopwords, collocations)
+
+def _wc_count_batch(texts):
+    '''
+    Process pool worker for wc_count_parallel: wc_words and wc_count over
+    one batch of message texts.  The word cache lasts for the life of the
+    worker.  Returns (counted, cache hits, cache misses) for this batch.
+    '''
+    classify, stopwords, collocations = _wc_worker
+    before = classify.cache_info()
+    counted = wc_count(wc_words(texts, classify), stopwords, collocations)
+    after = classify.cache_info()
+    return (counted, after.hits - before.hits, after.misses - before.misses)
+
+def wc_count_parallel(texts, excluded_words, cache_size, wc, jobs, batch=1000):
+    '''
+    wc_count over a stream of message texts, in batches of batch texts on a
+    pool of jobs processes.  Returns (counted, cache hits, cache misses), the
+    same counts counting all of texts in one process would give.  Only a few
+    batches per process are ever read ahead of the merge.
+    '''
+    batches = iter(lambda: list(islice(texts, batch)), [])
+    hits = misses = 0
+    def counted_batches(pool):
+        nonlocal hits, misses
+        # Pool.imap would read every batch ahead of the workers; keep a
+        # bounded window of batches in flight and take them back in order
+        pending = deque()
+        while True:
+            texts = next(batches, None)
+            if texts is not None:
+                pending.append(pool.apply_async(_wc_count_batch, (texts,)))
+                if len(pending) < jobs * 2:
+                    continue
+            if not pending:
+                return
+            counted, _hits, _misses = pending.popleft().get()
+            hits += _hits
+            misses += _misses
+            yield counted
+    initargs = (excluded_words, cache_size, wc_stopwords(wc), wc.collocations)
+    with multiprocessing.Pool(jobs, _wc_init_worker, initargs) as pool:
+        counted = wc_merge(counted_batches(pool))
+    return (counted, hits, misses)
+
+def tg_word_cloud(messages, args, words=None):
     mask = None
     if args.wc_mask:
         mask = numpy.array(Image.open(args.wc_mask))
@@ -316,33 +667,174 @@ def tg_word_cloud(messages, args, words=None):
     if not messages and not words:
         return
 
-    if words:
-        _words = []
-        for word in words:
-            word = word.strip(punctuation).replace('’', '\'')
-            if word and word.lower() not in excluded_words and not is_emoji(word) and "://" not in word:
-                _words.append(word)
-        words = _words
+    wc = WordCloud(max_words=args.wc_num, mask=mask, background_color=args.wc_background, collocations=args.wc_collocations)
+    jobs = args.jobs or os.cpu_count()
+    if words or jobs < 2:
+        classify = wc_word_classifier(excluded_words, args.wc_cache_size)
+        if words:
+            words = filter(None, map(classify, words))
+        elif isinstance(messages, TgColumns):
+            words = wc_words(messages.column("text"), classify)
+        else:
+            words = wc_words((msg["text"] for msg in messages.values()), classify)
+        topwords, frequencies = wc_frequencies(words, wc)
+        info = classify.cache_info()
+        hits, misses = info.hits, info.misses
     else:
-        words = []
-        for msg in messages.values():
-            if not msg["text"]:
-                continue
-            for word in html_escape_re.subn("", html_tag_re.subn("", msg["text"])[0])[0].split():
-                word = word.strip(punctuation).replace('’', '\'')
-                if word and word.lower() not in excluded_words and not is_emoji(word) and "://" not in word:
-                    words.append(word)
-    
-    topwords = defaultdict(int)
-    for word in words:
-        topwords[word] += 1
+        if isinstance(messages, TgColumns):
+            texts = iter(messages.column("text"))
+        else:
+            texts = (msg["text"] for msg in messages.values())
+        counted, hits, misses = wc_count_parallel(texts, excluded_words, args.wc_cache_size, wc, jobs)
+        topwords, frequencies = wc_frequencies(None, wc, counted)
     print(top_n(topwords, 100))
+    if hits + misses:
+        print("word cache: {} hits, {} misses, {:.1%} hit rate".format(hits, misses, hits / (hits + misses)))
 
-    text = ' '.join(words)
-
-    wc = WordCloud(max_words=args.wc_num, mask=mask, background_color=args.wc_background).generate(text)
+    wc.generate_from_frequencies(frequencies)
     wc.to_file(args.wc)
 
+def messages_by_id(messages):
+    '''
+    Yields the messages in id order, one at a time.  Only the ids are
+    sorted, not a list of the messages.
+    '''
+    if isinstance(messages, TgColumns):
+        return (messages.row(row) for row in messages.id_order)
+    return (messages[msg_id] for msg_id in sorted(messages, key=int))
+
+def json_encoder(fast=False):
+    '''
+    Returns a function encoding a message (or a list of them) as a JSON
+    string: json.dumps, or with fast, orjson if it is installed.  orjson
+    writes compact JSON with non-ASCII characters as they are, so its output
+    is the same data but not the same bytes.
+    '''
+    if fast:
+        try:
+            import orjson
+            return lambda msg: orjson.dumps(msg, default=json_default).decode("utf-8")
+        except ImportError:
+            print("orjson is not installed, using json", file=sys.stderr)
+    return lambda msg: json.dumps(msg, default=json_default)
+
+def open_output(path=None, compress=None):
+    '''
+    Opens the file at path (or stdout) for writing text through a 1MB
+    buffer, and gzip or zstd compression if asked for.  compress defaults
+    to what path ends in: .gz or .zst.
+    '''
+    if compress is None and path:
+        compress = {".gz": "gzip", ".zst": "zstd"}.get(os.path.splitext(path)[1])
+    if not compress:
+        if path:
+            return open(path, "w", encoding="utf-8", buffering=1 << 20)
+        return nullcontext(sys.stdout)
+    # whatever was printed so far goes out before the compressed bytes
+    sys.stdout.flush()
+    if compress == "gzip":
+        stream = gzip.open(path, "wb") if path else gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb")
+    elif compress == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd output needs the zstandard package")
+        stream = zstandard.ZstdCompressor().stream_writer(open(path, "wb") if path else sys.stdout.buffer, closefd=bool(path))
+    else:
+        raise Exception(f"Unknown compression: {compress}")
+    return io.TextIOWrapper(io.BufferedWriter(stream, 1 << 20), encoding="utf-8")
+
+def tg_dump_messages(messages, args, filters=()):
+    '''
+    Writes the messages that pass every one of filters, in id order, as
+    --dump, --dumpjson or --dumpjsonl asked for, to --output or stdout.
+    Each message is written as soon as it is encoded, so memory does not
+    grow with the number of messages.
+    '''
+    encode = json_encoder(args.fast_json)
+    output = messages_by_id(messages)
+    if filters:
+        output = (msg for msg in output if all(keep(msg) for keep in filters))
+    with open_output(args.output, args.compress) as OUT:
+        if args.dumpjson:
+            # the same bytes print(encode(list)) would write.  Encoding a
+            # thousand messages at a time is faster than one at a time.
+            separator = encode([0, 0])[2:-2]
+            OUT.write("[")
+            for n, batch in enumerate(iter(lambda: list(islice(output, 1000)), [])):
+                OUT.write(separator + encode(batch)[1:-1] if n else encode(batch)[1:-1])
+            OUT.write("]\n")
+        elif args.dumpjsonl:
+            for msg in output:
+                OUT.write(encode(msg) + "\n")
+        else:
+            for msg in output:
+                OUT.write(str(msg) + "\n")
+
+def tg_relationship(graph, names, topn):
+    '''
+    Takes a TgGraph and a list of names.
+    Prints who each of names replies to and mentions most, and how often
+    each pair of them replied to and mentioned each other.  Without names,
+    prints the top pairs of the whole chat.
+    '''
+    unknown = [name for name in names if name not in graph.node]
+    if unknown:
+        raise Exception("No messages from or mentioning: {}".format(", ".join(unknown)))
+
+    if not names:
+        for edge in EDGES:
+            print()
+            print(f"Top {edge}:")
+            for source, target, count, back in graph.top_pairs(edge, topn, exclude=["Deleted Account"]):
+                print(f"{count}\t{source} -> {target} ({back} back)")
+            mutual, answered = graph.reciprocity(edge)
+            print(f"Reciprocity: {mutual:.1%} of pairs both ways, {answered:.1%} of {edge} matched the other way")
+        return
+
+    for name in names:
+        print()
+        print(f"{name}:")
+        for edge in EDGES:
+            given = ", ".join(f"{other} {count}" for other, count in graph.partners(edge, name, topn))
+            received = ", ".join(f"{other} {count}" for other, count in graph.partners(edge, name, topn, incoming=True))
+            print(f"  {edge} to: {given or 'nobody'}")
+            print(f"  {edge} from: {received or 'nobody'}")
+
+    for first, second in combinations(names, 2):
+        print()
+        print(f"{first} and {second}:")
+        for edge in EDGES:
+            there = graph.weight(edge, first, second)
+            back = graph.weight(edge, second, first)
+            balance = min(there, back) / max(there, back) if there or back else 0
+            print(f"  {edge}: {there} {first} -> {second}, {back} {second} -> {first} (reciprocity {balance:.0%})")
+
+def pretty_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    return f"{days}d {hours:02d}:{minutes:02d}:{seconds:02d}" if days else f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def tg_threads(messages, args):
+    '''
+    Prints the largest (or, by duration, longest) conversation threads:
+    messages joined by replies and links to each other.
+    '''
+    threads = TgThreads(messages)
+    print()
+    print("Longest threads:" if args.threads_by == "duration" else "Largest threads:")
+    for thread in threads.top(args.threads, args.threads_by):
+        missing = len(thread["missing"])
+        print("{} messages\t{}\t{} talkers, from {}, starting at message {}{}".format(
+            thread["size"],
+            pretty_duration(thread["duration"]),
+            len(thread["talkers"]),
+            pretty_time(thread["start"])[0] if thread["start"] is not None else "an unknown time",
+            thread["first"],
+            f" (replies to {missing} missing messages)" if missing else "",
+        ))
+
 def tg_nevertalkers(messages, actions):
     message_counts = defaultdict(int)
     for message in messages.values():
@@ -355,6 +847,39 @@ def tg_nevertalkers(messages, actions):
     for silent_joiner in joined_no_messages:
         print("Name: {}, ID: {}, last joined: {}".format(silent_joiner["actor"], silent_joiner["actor_id"], silent_joiner["date_unixtime"]))
 
+# the message fields each command reads, None for all of them.  Only the
+# fields of the commands a run asks for are parsed or loaded (see
+# plan_fields); ids and timestamps always are.  A new command goes here too.
+COMMAND_FIELDS = {
+    "report": ("from_name", "reply_to", "links", "media"),
+    "perday": ("from_name",),
+    "nevertalkers": ("from_id",),
+    "dump": None,
+    "dumpjson": None,
+    "dumpjsonl": None,
+    "query": ("text", "from_name", "mentions"),
+    "wc": ("text",),
+    "threads": ("from_name", "reply_to", "message_links"),
+    "relationship": ("from_name", "reply_to", "mentions"),
+    # whatever is written has to have everything
+    "write_pickle": None,
+    "write_cache": None,
+}
+
+def plan_fields(args):
+    '''
+    Returns the set of message fields the commands in args need (see
+    COMMAND_FIELDS), or None if they need all of them.
+    '''
+    fields = set()
+    for command, needs in COMMAND_FIELDS.items():
+        if getattr(args, command) in (None, False, 0):
+            continue
+        if needs is None:
+            return None
+        fields.update(needs)
+    return message_projection(fields)
+
 def mk_epochtime(thedate):
     if date_re.match(thedate):
         return datetime.strptime(thedate, "%Y-%m-%d").timestamp()
@@ -365,23 +890,43 @@ def parse_args():
     source = parser.add_mutually_exclusive_group()
     source.add_argument("--sources", default=[], nargs="+", help="One or more Telegram exports, either JSON results files or directories of HTML files")
     source.add_argument("--pickle", default=None, help="pickle file containing parsed messages")
+    source.add_argument("--cache", default=None, help="message cache directory written by --write-cache (loaded lazily)")
+    parser.add_argument("--stream", default=False, action="store_true", help="decode JSON exports incrementally instead of loading the whole file (lower memory on large exports)")
+    parser.add_argument("--jobs", default=1, type=int, help="number of worker processes for parsing HTML exports and counting wordcloud words (0 for one per CPU)")
+    parser.add_argument("--interpolate-timestamps", default=False, action="store_true", help="fill in missing timestamps by interpolating between the messages around them instead of repeating the previous one")
+    parser.add_argument("--lazy-text", default=False, action="store_true", help="convert the message text of HTML exports only when something reads it, so --report and --perday skip the conversion")
     parser.add_argument("--write-pickle", default=None, help="specify a filename to write parsed messages to a pickle file")
+    parser.add_argument("--store", default=None, help="incremental message store directory: --sources are only parsed where they changed since the last run and new messages are added to the store, then everything in it is analysed")
+    parser.add_argument("--backfill", default=False, action="store_true", help="with --store, also ingest messages older than the newest one stored (from an export older than the store); otherwise only newer messages are parsed")
+    parser.add_argument("--write-cache", default=None, help="write parsed messages to this cache directory; works with --pickle to convert old pickles")
+    parser.add_argument("--columnar", default=False, action="store_true", help="hold messages in numpy columns and run the analyses as array operations")
     parser.add_argument("--report", default=False, action="store_true", help="print report")
     parser.add_argument("--perday", default=False, action="store_true", help="print data about talkers per day")
+    parser.add_argument("--perday-bucket", default="day", choices=sorted(activity_buckets), help="bucket size for --perday (default is day)")
     parser.add_argument("--topn", default=20, type=int, help="Count of topN lists in report")
     parser.add_argument("--not_before", default=None, help="epoch timestamp of earliest desired message (or YYYY-MM-DD)", type=mk_epochtime)
     parser.add_argument("--not_after", default=None, help="epoch timestamp of latest desired message (or YYYY-MM-DD)", type=mk_epochtime)
     parser.add_argument("--dump", default=False, action="store_true", help="dump all messages to console")
     parser.add_argument("--dumpjson", default=False, action="store_true", help="dump messages in json format")
     parser.add_argument("--dumpjsonl", default=False, action="store_true", help="dump messages in newline-delimited json format")
-    parser.add_argument("--search", default=None, help="search regex for message dump")
+    parser.add_argument("--output", default=None, help="write --dump, --dumpjson or --dumpjsonl to this file instead of stdout")
+    parser.add_argument("--compress", default=None, choices=["gzip", "zstd"], help="compress the dump (default is by --output's extension, .gz or .zst; zstd needs the zstandard package)")
+    parser.add_argument("--fast-json", default=False, action="store_true", help="encode the dump with orjson if it is installed (compact, non-ASCII left unescaped)")
+    parser.add_argument("--search", default=None, help="search regex for message dump (matched against the whole message, field names and all)")
+    parser.add_argument("--query", default=None, help="search the message dump with the word index: words (all must match), word* for prefixes, from:name, mention:name, re:regex (checked on message text)")
+    parser.add_argument("--index", default=None, help="directory to keep the --query index in (default is index/ in the --cache or --store directory; otherwise it is built in memory)")
     parser.add_argument("--wc", default=None, help="generate wordcloud and store in this PNG filename")
     parser.add_argument("--wc-mask", default=None, help="file containing image mask for wordcloud")
     parser.add_argument("--wc-exclude", default=None, help="file containing words to exclude from wordcloud, one per line")
     parser.add_argument("--wc-num", default=1000, type=int, help="number of words to include in wordcloud")
     parser.add_argument("--wc-background", default="white", help="wordcloud background color (default is white)")
+    parser.add_argument("--no-wc-collocations", dest="wc_collocations", default=True, action="store_false", help="leave common two-word phrases out of the wordcloud (counting them takes memory per distinct pair of words, not just per word)")
+    parser.add_argument("--wc-cache-size", default=100000, type=int, help="number of distinct words whose wordcloud filtering is remembered (default is 100000)")
     parser.add_argument("--words", default=[], nargs="*", help="Manually enter words for wordcloud")
-    parser.add_argument("--relationship", default=[], nargs="*", help="Print a summary of the relationship between a set of users")
+    parser.add_argument("--relationship", default=None, nargs="*", help="Print a summary of the relationship between a set of users (with no users, the top pairs of the whole chat)")
+    parser.add_argument("--graph", default=None, help="directory to keep the --relationship graph in (default is graph/ in the --cache or --store directory; otherwise it is built in memory)")
+    parser.add_argument("--threads", default=None, type=int, help="print this many of the largest conversation threads (messages joined by replies and message links)")
+    parser.add_argument("--threads-by", default="size", choices=["size", "duration"], help="rank --threads by number of messages or by how long they went on (default is size)")
     parser.add_argument("--nevertalkers", default=False, action="store_true", help="Print a list of accounts that have never sent a message")
     return parser.parse_args()
 
@@ -391,10 +936,20 @@ def main():
     messages = TgDump()
     actions = []
 
-    if not args.pickle and not args.sources:
-        raise Exception("No data. Please specify one of: --pickle, --sources")
+    if not args.pickle and not args.sources and not args.cache and not args.store:
+        raise Exception("No data. Please specify one of: --pickle, --sources, --cache, --store")
+
+    fields = plan_fields(args)
 
-    if args.pickle:
+    if args.store:
+        store = TgStore(args.store)
+        if args.sources:
+            added = store.ingest(args.sources, streaming=args.stream, jobs=args.jobs, interpolate=args.interpolate_timestamps, backfill=args.backfill)
+            print(f"added {added} messages to {args.store}")
+        messages = store.load(fields)
+    elif args.cache:
+        messages = TgColumns.load(args.cache, fields)
+    elif args.pickle:
         with open(args.pickle, "rb") as IMAPICKLEMORTY:
             messages = pickle.load(IMAPICKLEMORTY)
         for id, msg in messages.items():
@@ -406,11 +961,11 @@ def main():
             _messages = None
             if os.path.isdir(source):
                 if "result.json" in os.listdir(source):
-                    _messages, _actions = TgDumpParser(os.path.join(source, "result.json"))()
+                    _messages, _actions = TgDumpParser(os.path.join(source, "result.json"), streaming=args.stream, jobs=args.jobs, interpolate=args.interpolate_timestamps, lazy_text=args.lazy_text, fields=fields)()
                 else:
-                    _messages, _actions = TgDumpParser(source)()
+                    _messages, _actions = TgDumpParser(source, streaming=args.stream, jobs=args.jobs, interpolate=args.interpolate_timestamps, lazy_text=args.lazy_text, fields=fields)()
             elif os.path.isfile(source):
-                _messages, _actions = TgDumpParser(source)()
+                _messages, _actions = TgDumpParser(source, streaming=args.stream, jobs=args.jobs, interpolate=args.interpolate_timestamps, lazy_text=args.lazy_text, fields=fields)()
             if _messages:
                 dumps.append(_messages)
                 _actions.extend(_actions) # this is insufficient
@@ -422,9 +977,8 @@ def main():
 
         dumps.sort(key=lambda dump: str(dump.earliest) + str(dump.latest))
 
-        for dump, source in zip(dumps, args.sources):
-            print(f"merging {source}")
-            messages.merge(dump)
+        print(f"merging {len(dumps)} source{'s' if len(dumps) != 1 else ''}")
+        messages.merge(*dumps)
 
         if args.write_pickle:
             with open(args.write_pickle, "wb") as IMAPICKLEMORTY:
@@ -434,44 +988,55 @@ def main():
         print("No messages")
         sys.exit(1)
 
+    if args.columnar and not isinstance(messages, TgColumns):
+        messages = TgColumns.from_dump(messages)
+
+    if args.write_cache:
+        columns = messages if isinstance(messages, TgColumns) else TgColumns.from_dump(messages)
+        columns.save(args.write_cache)
+
+    if args.query is not None:
+        # before the date filter, so the saved index covers every message
+        index_path = args.index
+        if index_path is None and (args.cache or args.store):
+            index_path = os.path.join(args.cache or args.store, "index")
+        matched = set(TgSearchIndex.open(messages, index_path).search(args.query, messages).tolist())
+
     if args.not_before or args.not_after:
-        def indaterange(msg):
-            if args.not_before and messages[msg]["timestamp"] < args.not_before:
-                return False
-            if args.not_after and messages[msg]["timestamp"] > args.not_after:
-                return False
-            return True
-        messages = TgDump((k, v) for (k, v) in messages.items() if indaterange(k))
+        messages = messages.between(args.not_before or None, args.not_after or None)
 
     if args.nevertalkers:
         tg_nevertalkers(messages, actions)
 
     if args.dump or args.dumpjson or args.dumpjsonl:
-        output = list(messages.values())
-        output.sort(key = lambda msg: int(msg["id"]))
+        filters = []
         if args.search is not None:
             search_re = re.compile(args.search)
-            output = [msg for msg in output if search_re.search(str(msg))]
-        if args.dumpjson:
-            print(json.dumps(output))
-        elif args.dumpjsonl:
-            for message in output:
-                print(json.dumps(message))
-        else:
-            for msg in output:
-                print(msg)
+            filters.append(lambda msg: search_re.search(str(msg)))
+        if args.query is not None:
+            filters.append(lambda msg: int(msg["id"]) in matched)
+        tg_dump_messages(messages, args, filters)
 
     if args.report:
         tg_report(messages, args)
 
     if args.perday:
-        tg_per_day(messages)
+        tg_per_day(messages, bucket=args.perday_bucket)
 
     if args.wc:
         tg_word_cloud(messages, args, words=args.words)
 
-    if args.relationship:
-        tg_relationship(*args.relationship)
+    if args.threads:
+        tg_threads(messages, args)
+
+    if args.relationship is not None:
+        graph_path = args.graph
+        if graph_path is None and (args.cache or args.store):
+            graph_path = os.path.join(args.cache or args.store, "graph")
+        if args.not_before or args.not_after:
+            # the saved graph covers every message, build one for the range
+            graph_path = None
+        tg_relationship(TgGraph.open(messages, graph_path), args.relationship, args.topn)
 
 if __name__ == "__main__":
     main()
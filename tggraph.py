@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import html
+import numpy
+import os
+
+from tgcolumns import Interner, TgColumns, load_array, message_id, open_saved, read_meta, write_meta
+
+"""
+TgGraph is who talks to whom, for --relationship: weighted, directed
+adjacency matrices of replies (from the replier to the author of the
+message replied to) and mentions (from the author to everyone mentioned),
+over one table of people.  A mention is matched to an author's name with or
+without its leading @ (and unescaped, as HTML exports leave it); the ones
+that match no author are people of their own.  Messages without an author,
+and replies to messages that are not in the dump, are left out.
+
+The matrices are sparse (see SparseCounts), so they take memory per pair of
+people who ever talked rather than per pair of people, and looking up a pair
+is a binary search.
+
+The graph can be saved to a directory (by default the graph/ directory of
+the --cache or --store in use) and is rebuilt when the messages no longer
+match it (see tgcolumns.fingerprint):
+
+    meta.json                version, fingerprint of the messages, names
+    replies.indptr.npy       where each person's row starts
+    replies.indices.npy      who each person replied to, sorted by row
+    replies.weights.npy      how many times
+    mentions.*.npy           the same for mentions
+"""
+
+GRAPH_VERSION = 1
+EDGES = ["replies", "mentions"]
+# the message fields the graph is built from
+MESSAGE_FIELDS = ("id", "from_name", "reply_to", "mentions")
+
+
+class SparseCounts(object):
+    """
+    A square matrix of counts in compressed sparse row form: row r holds
+    weights[indptr[r]:indptr[r + 1]] in the columns indices[indptr[r]:
+    indptr[r + 1]], which are sorted.
+    """
+
+    def __init__(self, indptr, indices, weights):
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self._keys = None
+
+    @classmethod
+    def from_pairs(cls, size, rows, columns):
+        """
+        Counts each (rows[i], columns[i]) pair of an size x size matrix.
+        """
+        keys = numpy.asarray(rows, dtype=numpy.int64) * size + numpy.asarray(columns, dtype=numpy.int64)
+        keys, weights = numpy.unique(keys, return_counts=True)
+        indptr = numpy.zeros(size + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(keys // size, minlength=size), out=indptr[1:])
+        return cls(indptr, keys % size, weights.astype(numpy.int64))
+
+    @property
+    def size(self):
+        return len(self.indptr) - 1
+
+    @property
+    def keys(self):
+        # row * size + column of every count, which compressed rows keep sorted
+        if self._keys is None:
+            self._keys = self.rows() * self.size + self.indices
+        return self._keys
+
+    def rows(self):
+        """
+        The row of every count, to go with indices and weights.
+        """
+        return numpy.repeat(numpy.arange(self.size, dtype=numpy.int64), numpy.diff(self.indptr))
+
+    def row(self, row):
+        """
+        Returns (columns, counts) of a row.
+        """
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return (numpy.asarray(self.indices[start:end]), numpy.asarray(self.weights[start:end]))
+
+    def lookup(self, rows, columns):
+        """
+        Returns the counts at (rows[i], columns[i]), 0 where there are none.
+        """
+        wanted = numpy.asarray(rows, dtype=numpy.int64) * self.size + numpy.asarray(columns, dtype=numpy.int64)
+        if not len(self.keys):
+            return numpy.zeros(len(wanted), dtype=numpy.int64)
+        pos = numpy.searchsorted(self.keys, wanted)
+        pos[pos == len(self.keys)] = 0
+        return numpy.where(self.keys[pos] == wanted, self.weights[pos], 0)
+
+    def get(self, row, column):
+        return int(self.lookup([row], [column])[0])
+
+
+class TgGraph(object):
+    def __init__(self, names, edges, fingerprint=None):
+        # edge -> SparseCounts, rows and columns are indexes into names
+        self.names = names
+        self.edges = edges
+        self.fingerprint = fingerprint
+        self.node = {name: idx for idx, name in enumerate(names)}
+
+    @classmethod
+    def build(cls, messages, fingerprint=None):
+        """
+        Builds the graph of a TgDump (or TgDumpView) or TgColumns, in one
+        pass over the messages, with the fingerprint of the messages if it
+        is to be saved.
+        """
+        people = Interner()
+        if isinstance(messages, TgColumns):
+            # author indexes are node indexes
+            for name in messages.names:
+                people(name)
+            author = numpy.asarray(messages.column("author"))
+            sources, targets = messages.reply_targets()
+            reply_rows, reply_columns = author[sources], author[targets]
+            mentions = zip(author.tolist(), messages.column("mentions"))
+        else:
+            reply_rows = []
+            reply_columns = []
+            mentions = []
+            for msg in messages.values():
+                if msg.get("from_name") is None:
+                    continue
+                source = people(msg["from_name"])
+                for _id in map(message_id, msg.get("reply_to") or ()):
+                    if _id in messages and messages[_id].get("from_name") is not None:
+                        reply_rows.append(source)
+                        reply_columns.append(people(messages[_id]["from_name"]))
+                if msg.get("mentions"):
+                    mentions.append((source, msg["mentions"]))
+
+        # every author is known now, so "@name" can be matched to "name"
+        authors = dict(people.index)
+        mentioned = {}
+        mention_rows = []
+        mention_columns = []
+        for source, _mentions in mentions:
+            if source < 0:
+                continue
+            for mention in _mentions or ():
+                if mention not in mentioned:
+                    # HTML exports leave mentions escaped
+                    name = html.unescape(mention)
+                    if name in authors:
+                        mentioned[mention] = authors[name]
+                    elif name.startswith("@") and name[1:] in authors:
+                        mentioned[mention] = authors[name[1:]]
+                    else:
+                        mentioned[mention] = people(name)
+                mention_rows.append(source)
+                mention_columns.append(mentioned[mention])
+
+        reply_rows = numpy.asarray(reply_rows, dtype=numpy.int64)
+        reply_columns = numpy.asarray(reply_columns, dtype=numpy.int64)
+        known = (reply_rows >= 0) & (reply_columns >= 0)
+        size = len(people.values)
+        edges = {
+            "replies": SparseCounts.from_pairs(size, reply_rows[known], reply_columns[known]),
+            "mentions": SparseCounts.from_pairs(size, mention_rows, mention_columns),
+        }
+        return cls(people.values, edges, fingerprint)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for edge, counts in self.edges.items():
+            for name in ("indptr", "indices", "weights"):
+                numpy.save(os.path.join(path, "{}.{}.npy".format(edge, name)), getattr(counts, name))
+        meta = {
+            "version": GRAPH_VERSION,
+            "fingerprint": self.fingerprint,
+            "names": self.names,
+            "edges": list(self.edges),
+        }
+        write_meta(path, meta)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Opens a graph directory written by save, memory-mapped.  Returns
+        None if there is no graph there or it is from another version.
+        """
+        meta = read_meta(path, GRAPH_VERSION)
+        if meta is None:
+            return None
+        edges = {}
+        for edge in meta["edges"]:
+            edges[edge] = SparseCounts(*(load_array(os.path.join(path, "{}.{}.npy".format(edge, name)))
+                                         for name in ("indptr", "indices", "weights")))
+        return cls(meta["names"], edges, meta["fingerprint"])
+
+    @classmethod
+    def open(cls, messages, path=None):
+        """
+        Returns the graph of messages, the one saved in path if it is theirs
+        (see tgcolumns.open_saved).
+        """
+        return open_saved(cls, messages, path, MESSAGE_FIELDS)
+
+    def weight(self, edge, source, target):
+        """
+        Returns how many times source replied to (or mentioned) target.
+        """
+        if source not in self.node or target not in self.node:
+            return 0
+        return self.edges[edge].get(self.node[source], self.node[target])
+
+    def partners(self, edge, name, n, incoming=False):
+        """
+        Returns the top n [(name, count)] that name replied to (or
+        mentioned), or with incoming, that replied to (mentioned) name,
+        most first.
+        """
+        counts = self.edges[edge]
+        node = self.node[name]
+        if incoming:
+            others = numpy.flatnonzero(counts.indices == node)
+            sources = numpy.searchsorted(counts.indptr, others, side="right") - 1
+            columns, weights = sources, numpy.asarray(counts.weights)[others]
+        else:
+            columns, weights = counts.row(node)
+        order = numpy.argsort(-weights, kind="stable")[:n]
+        return [(self.names[columns[idx]], int(weights[idx])) for idx in order]
+
+    def pairs(self, edge):
+        """
+        Returns (sources, targets, counts, counts back) for every pair of
+        different people where source replied to (or mentioned) target.
+        """
+        counts = self.edges[edge]
+        rows = counts.rows()
+        columns = numpy.asarray(counts.indices)
+        weights = numpy.asarray(counts.weights)
+        others = rows != columns
+        rows, columns, weights = rows[others], columns[others], weights[others]
+        return (rows, columns, weights, counts.lookup(columns, rows))
+
+    def top_pairs(self, edge, n, exclude=()):
+        """
+        Returns the top n [(source, target, count, count back)], most first,
+        leaving out anyone in exclude.
+        """
+        rows, columns, weights, back = self.pairs(edge)
+        excluded = [self.node[name] for name in exclude if name in self.node]
+        keep = ~(numpy.isin(rows, excluded) | numpy.isin(columns, excluded))
+        rows, columns, weights, back = rows[keep], columns[keep], weights[keep], back[keep]
+        order = numpy.argsort(-weights, kind="stable")[:n]
+        return [(self.names[rows[idx]], self.names[columns[idx]], int(weights[idx]), int(back[idx])) for idx in order]
+
+    def reciprocity(self, edge):
+        """
+        Returns (mutual, answered): the share of the pairs where one person
+        replied to (mentioned) another in which the other did too, and the
+        share of all replies (mentions) matched by as many the other way.
+        """
+        rows, columns, weights, back = self.pairs(edge)
+        if not len(weights):
+            return (0.0, 0.0)
+        return (float((back > 0).mean()), float(numpy.minimum(weights, back).sum() / weights.sum()))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import numpy
+import os
+import re
+
+from bisect import bisect_left
+from collections import defaultdict
+from tgcolumns import StringHeap, TgColumns, load_array, open_saved, read_meta, write_meta
+
+"""
+TgSearchIndex is an inverted index over the words of message texts, author
+names and mentions, for --query.  Words are lowercased runs of \\w, and each
+word maps to the sorted ids of the messages it appears in.
+
+A query is a list of terms, all of which must match:
+
+    word            messages with word in their text
+    word*           messages with a word starting with word in their text
+    from:name       messages whose author's name has the word name in it
+    mention:name    messages mentioning someone with the word name in their name
+    re:regex        messages whose text matches regex
+
+from: and mention: take prefixes (from:sky*) too.  The re: terms are only
+checked on the messages the other terms matched, so "python re:py(thon)?3"
+reads the text of the messages with "python" in them, not of every message.
+
+The index can be saved to a directory (by default the index/ directory of
+the --cache or --store in use) and is rebuilt when the messages no longer
+match it (see tgcolumns.fingerprint):
+
+    meta.json                version, fingerprint of the messages, fields
+    <field>.terms.*          the sorted words of a field, as a StringHeap
+    <field>.offsets.npy      where each word's ids start in the postings
+    <field>.postings.npy     the message ids of every word, one after the other
+"""
+
+INDEX_VERSION = 1
+FIELDS = ["text", "from", "mention"]
+# the message fields the index is built from
+MESSAGE_FIELDS = ("id", "text", "from_name", "mentions")
+word_re = re.compile(r"\w+")
+
+
+def words(text):
+    return word_re.findall(text.lower()) if text else []
+
+
+class TgSearchIndex(object):
+    def __init__(self, fields, fingerprint=None):
+        # field -> (sorted terms, offsets, postings)
+        self.fields = fields
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, messages, fingerprint=None):
+        """
+        Builds the index of a TgDump or TgColumns, with the fingerprint of
+        the messages if it is to be saved.
+        """
+        postings = {field: defaultdict(list) for field in FIELDS}
+        if isinstance(messages, TgColumns):
+            order = messages.id_order
+            ids = numpy.asarray(messages.column("id"))[order].tolist()
+            texts = messages.column("text")[order]
+            authors = numpy.asarray(messages.column("author"))[order].tolist()
+            names = [words(name) for name in messages.names]
+            from_words = [names[author] if author >= 0 else [] for author in authors]
+            mentions = messages.column("mentions")[order]
+        else:
+            ids = sorted(messages)
+            texts = [messages[msg_id]["text"] for msg_id in ids]
+            from_words = [words(messages[msg_id]["from_name"]) for msg_id in ids]
+            mentions = [messages[msg_id]["mentions"] for msg_id in ids]
+
+        for msg_id, text, _from, _mentions in zip(ids, texts, from_words, mentions):
+            msg_id = int(msg_id)
+            for word in set(words(text)):
+                postings["text"][word].append(msg_id)
+            for word in set(_from):
+                postings["from"][word].append(msg_id)
+            for word in set(word for mention in _mentions or () for word in words(mention)):
+                postings["mention"][word].append(msg_id)
+
+        fields = {}
+        for field, by_term in postings.items():
+            terms = sorted(by_term)
+            offsets = numpy.zeros(len(terms) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(by_term[term]) for term in terms], out=offsets[1:])
+            flat = numpy.fromiter((msg_id for term in terms for msg_id in by_term[term]), dtype=numpy.int64, count=int(offsets[-1]))
+            fields[field] = (terms, offsets, flat)
+        return cls(fields, fingerprint)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for field, (terms, offsets, postings) in self.fields.items():
+            StringHeap.write(os.path.join(path, field + ".terms"), terms)
+            numpy.save(os.path.join(path, field + ".offsets.npy"), offsets)
+            numpy.save(os.path.join(path, field + ".postings.npy"), postings)
+        meta = {
+            "version": INDEX_VERSION,
+            "fingerprint": self.fingerprint,
+            "fields": list(self.fields),
+        }
+        write_meta(path, meta)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Opens an index directory written by save, memory-mapped.  Returns
+        None if there is no index there or it is from another version.
+        """
+        meta = read_meta(path, INDEX_VERSION)
+        if meta is None:
+            return None
+        fields = {}
+        for field in meta["fields"]:
+            fields[field] = (
+                StringHeap.load(os.path.join(path, field + ".terms")),
+                load_array(os.path.join(path, field + ".offsets.npy")),
+                load_array(os.path.join(path, field + ".postings.npy")),
+            )
+        return cls(fields, meta["fingerprint"])
+
+    @classmethod
+    def open(cls, messages, path=None):
+        """
+        Returns the index of messages, the one saved in path if it is theirs
+        (see tgcolumns.open_saved).
+        """
+        return open_saved(cls, messages, path, MESSAGE_FIELDS)
+
+    def lookup(self, field, term):
+        """
+        Returns the sorted ids of the messages with term in field.  A term
+        ending in * matches every word it is a prefix of.
+        """
+        terms, offsets, postings = self.fields[field]
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        idx = bisect_left(terms, term)
+        if not prefix:
+            if idx < len(terms) and terms[idx] == term:
+                return numpy.asarray(postings[offsets[idx]:offsets[idx + 1]])
+            return numpy.zeros(0, dtype=numpy.int64)
+        end = idx
+        while end < len(terms) and terms[end].startswith(term):
+            end += 1
+        return numpy.unique(postings[offsets[idx]:offsets[end]])
+
+    def search(self, query, messages):
+        """
+        Returns the sorted ids of the messages matching query (see above).
+        """
+        found = None
+        patterns = []
+        for term in query.split():
+            field, _, value = term.partition(":")
+            if field == "re":
+                patterns.append(re.compile(value))
+                continue
+            if field not in FIELDS:
+                field, value = "text", term
+            # a term like "don't" is the words "don" and "t", all of which
+            # have to be there; only the last can be a prefix
+            value_words = words(value)
+            if value.endswith("*") and value_words:
+                value_words[-1] += "*"
+            for word in value_words:
+                ids = self.lookup(field, word)
+                found = ids if found is None else numpy.intersect1d(found, ids, assume_unique=True)
+        if found is None:
+            found = numpy.sort(numpy.asarray(messages.column("id")) if isinstance(messages, TgColumns) else numpy.fromiter(map(int, messages), dtype=numpy.int64))
+        if patterns:
+            # pickles from before ids were ints key their messages by strings
+            keys = None if isinstance(messages, TgColumns) else {int(msg_id): msg_id for msg_id in messages}
+            texts = ((msg_id, messages[keys[msg_id] if keys else msg_id]["text"]) for msg_id in found.tolist())
+            found = [msg_id for msg_id, text in texts if all(pattern.search(text or "") for pattern in patterns)]
+        return numpy.asarray(found, dtype=numpy.int64)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import numpy
+import os
+
+from tgcolumns import TgColumns
+from tgdump import TgDump, TgDumpParser, TgHtmlParser
+
+"""
+TgStore keeps parsed messages between runs so that a nightly export only
+costs as much as what changed since the last one.  A store is a directory:
+
+    manifest.json     format version, high-water mark (largest message id
+                      stored), the segments, and every source file already
+                      ingested with its size, mtime and sha256
+    segments/000001/  a TgColumns cache (see tgcolumns.py) per ingest
+
+Ingesting skips source files whose size and mtime match the manifest, or
+whose content hash matches any file ingested before, wherever it was (every
+export lands in a new ChatExport_* directory).  The rest are parsed, skipping
+the messages at or below the high-water mark before they are normalized,
+and what is not stored yet is merged and written as a new segment.  With
+backfill, the older messages of changed files are parsed too and checked
+against the stored ids, for exports older than the store.
+
+Messages already in the store are never rewritten: a later export that edits
+an old message does not change it, and names are only normalized within an
+ingest.  Rebuild the store from scratch to re-merge everything.
+"""
+
+STORE_VERSION = 1
+
+
+def fingerprint(path, content_hash=True):
+    stat = os.stat(path)
+    result = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if content_hash:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as SOURCE:
+            for chunk in iter(lambda: SOURCE.read(1 << 20), b""):
+                sha256.update(chunk)
+        result["sha256"] = sha256.hexdigest()
+    return result
+
+
+class TgStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.manifest = {
+            "version": STORE_VERSION,
+            "high_water": None,
+            "segments": [],
+            "sources": {},
+        }
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as MANIFEST:
+                self.manifest = json.load(MANIFEST)
+            if self.manifest.get("version") != STORE_VERSION:
+                raise Exception("Store {} has version {}, expected {}".format(
+                    path, self.manifest.get("version"), STORE_VERSION))
+        # sha256 -> path of every file ingested, to know a copy of one anywhere
+        self.hashes = {known["sha256"]: path for path, known in self.manifest["sources"].items()}
+        self.segments = None
+
+    def source_files(self, source):
+        """
+        Returns (dump, files): what to hand TgDumpParser for source, and the
+        export files behind it.
+        """
+        if os.path.isdir(source):
+            if "result.json" in os.listdir(source):
+                result = os.path.join(source, "result.json")
+                return (result, [result])
+            return (source, TgHtmlParser(source).message_files(source))
+        if os.path.isfile(source):
+            return (source, [source])
+        raise Exception(f"Invalid source: {source}")
+
+    def changed(self, path):
+        """
+        Returns the new fingerprint of path if it has not been ingested in
+        its current form, here or under any other path, None otherwise.
+        Files whose size and mtime match the manifest are not read at all.
+        """
+        path = os.path.abspath(path)
+        known = self.manifest["sources"].get(path)
+        current = fingerprint(path, content_hash=False)
+        if known and known["size"] == current["size"] and known["mtime"] == current["mtime"]:
+            return None
+        current = fingerprint(path)
+        if current["sha256"] in self.hashes:
+            # touched but not changed, or a copy of a file ingested from
+            # somewhere else: remember it, so next time it is not read
+            self.manifest["sources"][path] = current
+            return None
+        return current
+
+    def load_segments(self):
+        if self.segments is None:
+            self.segments = [TgColumns.load(os.path.join(self.path, "segments", name)) for name in self.manifest["segments"]]
+        return self.segments
+
+    def stored(self, msg_ids):
+        """
+        Returns a boolean array, True for each of msg_ids already in the store.
+        """
+        found = numpy.zeros(len(msg_ids), dtype=bool)
+        for segment in self.load_segments():
+            found |= segment.rows_of(msg_ids) >= 0
+        return found
+
+    def ingest(self, sources, streaming=False, jobs=1, interpolate=False, backfill=False):
+        """
+        Parses the new or changed files of sources and stores the messages
+        that are not stored yet.  Only the messages above the high-water mark
+        are parsed unless backfill is given.  Returns the number of messages
+        added.
+        """
+        dumps = []
+        fingerprints = {}
+        after_id = None if backfill else self.manifest["high_water"]
+        for source in sources:
+            dump, files = self.source_files(source)
+            changed = {}
+            for path in files:
+                current = self.changed(path)
+                if current:
+                    changed[os.path.abspath(path)] = current
+                    # a second copy in the same ingest is not new either
+                    self.hashes[current["sha256"]] = os.path.abspath(path)
+            if not changed:
+                print(f"skipping unchanged source {source}")
+                continue
+            print(f"processing source {source} ({len(changed)} of {len(files)} files changed)")
+            if os.path.isdir(dump):
+                _messages, _actions = TgDumpParser(dump, jobs=jobs, files=[path for path in files if os.path.abspath(path) in changed], interpolate=interpolate, after_id=after_id)()
+            else:
+                _messages, _actions = TgDumpParser(dump, streaming=streaming, interpolate=interpolate, after_id=after_id)()
+            if _messages:
+                dumps.append(_messages)
+            fingerprints.update(changed)
+
+        added = 0
+        if dumps:
+            dumps.sort(key=lambda dump: str(dump.earliest) + str(dump.latest))
+            messages = TgDump()
+            messages.merge(*dumps)
+            new = self.new_messages(messages)
+            if new:
+                self.write_segment(new)
+                added = len(new)
+        self.manifest["sources"].update(fingerprints)
+        self.write_manifest()
+        return added
+
+    def new_messages(self, messages):
+        """
+        Returns a TgDump of the messages that are not in the store.  Ids above
+        the high-water mark are new without looking; the others (a backfill
+        from an older export) are checked against the stored ids.
+        """
+        high_water = self.manifest["high_water"]
+        if high_water is None:
+            return messages
+        old_ids = numpy.array([msg_id for msg_id in messages if msg_id <= high_water], dtype=numpy.int64)
+        stored = set(old_ids[self.stored(old_ids)].tolist())
+        return messages.select(lambda msg: msg["id"] not in stored)
+
+    def write_segment(self, messages):
+        name = "{:06d}".format(len(self.manifest["segments"]) + 1)
+        columns = TgColumns.from_dump(messages)
+        columns.save(os.path.join(self.path, "segments", name))
+        self.manifest["segments"].append(name)
+        high_water = int(numpy.max(columns.column("id")))
+        if self.manifest["high_water"] is not None:
+            high_water = max(high_water, self.manifest["high_water"])
+        self.manifest["high_water"] = high_water
+        if self.segments is not None:
+            self.segments.append(columns)
+
+    def write_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.manifest_path + ".tmp", "w") as MANIFEST:
+            json.dump(self.manifest, MANIFEST, indent=1)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def load(self, fields=None):
+        """
+        Returns everything in the store as one TgColumns (or an empty TgDump),
+        with only fields if given (see TgColumns.project).
+        """
+        segments = self.load_segments()
+        if not segments:
+            return TgDump()
+        columns = segments[0] if len(segments) == 1 else TgColumns.concat(segments)
+        return columns if fields is None else columns.project(fields)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+from collections import defaultdict
+from tgcolumns import message_id
+
+"""
+TgThreads groups messages into conversations: a message is in the same
+thread as every message it replies to (reply_to) or links to
+(message_links), and so on down the chain.  The threads are the sets of a
+union-find forest over the message ids, so telling whether two messages are
+in the same thread, or finding a message's thread, is nearly constant time.
+
+A reply to a message that is not in the dump (deleted, older than the
+export or outside the date range) still joins the thread of everything else
+that replied to it.  Those messages are nodes of the forest too, but are not
+counted in the thread stats other than as missing.
+"""
+
+
+class TgThreads(object):
+    def __init__(self, messages, links=True):
+        """
+        Builds the threads of a TgDump (or anything with the same values()),
+        from reply_to and, with links, message_links.
+        """
+        self.messages = messages
+        # message id -> node; the nodes past len(self.ids) are missing messages
+        self.node = {}
+        self.ids = []
+        for msg in messages.values():
+            self.add(message_id(msg["id"]))
+        self.present = len(self.ids)
+        self.parent = list(range(self.present))
+        self.size = [1] * self.present
+        for msg in messages.values():
+            source = self.node[message_id(msg["id"])]
+            targets = list(msg.get("reply_to") or ())
+            if links:
+                targets.extend(msg.get("message_links") or ())
+            for target in targets:
+                target = message_id(target)
+                if target is None:
+                    continue
+                if target not in self.node:
+                    self.parent.append(self.add(target))
+                    self.size.append(1)
+                self.union(source, self.node[target])
+        self._stats = None
+
+    def add(self, msg_id):
+        self.node[msg_id] = len(self.ids)
+        self.ids.append(msg_id)
+        return self.node[msg_id]
+
+    def find(self, node):
+        parent = self.parent
+        while parent[node] != node:
+            # path halving: point every other node on the way at its grandparent
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(self, first, second):
+        first = self.find(first)
+        second = self.find(second)
+        if first == second:
+            return
+        # hang the smaller tree under the larger, so trees stay shallow
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+
+    def thread_of(self, msg_id):
+        """
+        Returns an opaque key of the thread msg_id is in (the same key for
+        every message in the thread), or None for an unknown id.
+        """
+        node = self.node.get(message_id(msg_id))
+        return None if node is None else self.find(node)
+
+    def same_thread(self, first, second):
+        first = self.thread_of(first)
+        return first is not None and first == self.thread_of(second)
+
+    def stats(self):
+        """
+        Returns {thread key: stats} for every thread, where stats is a dict of
+        the first message id, size (messages in the dump), talkers (the set of
+        from_names), start and end (timestamps, None if no message has one),
+        duration in seconds and missing (ids of the messages replied to or
+        linked that are not in the dump).
+        """
+        if self._stats is None:
+            stats = defaultdict(lambda: {"first": None, "size": 0, "talkers": set(), "start": None, "end": None, "missing": []})
+            for node, msg in enumerate(self.messages.values()):
+                thread = stats[self.find(node)]
+                if thread["first"] is None or self.ids[node] < thread["first"]:
+                    thread["first"] = self.ids[node]
+                thread["size"] += 1
+                thread["talkers"].add(msg.get("from_name"))
+                timestamp = msg.get("timestamp")
+                if timestamp is not None:
+                    if thread["start"] is None or timestamp < thread["start"]:
+                        thread["start"] = timestamp
+                    if thread["end"] is None or timestamp > thread["end"]:
+                        thread["end"] = timestamp
+            for node in range(self.present, len(self.ids)):
+                stats[self.find(node)]["missing"].append(self.ids[node])
+            for thread in stats.values():
+                thread["duration"] = thread["end"] - thread["start"] if thread["start"] is not None else 0
+            self._stats = dict(stats)
+        return self._stats
+
+    def thread(self, msg_id):
+        """
+        Returns the stats of the thread msg_id is in, or None.
+        """
+        key = self.thread_of(msg_id)
+        return None if key is None else self.stats()[key]
+
+    def top(self, n, key="size"):
+        """
+        Returns the stats of the n threads with the largest key ("size" or
+        "duration"), largest first.  Messages that neither reply to nor were
+        replied to are not threads.
+        """
+        threads = [thread for thread in self.stats().values() if thread["size"] > 1 or thread["missing"]]
+        threads.sort(key=lambda thread: (-thread[key], thread["first"]))
+        return threads[:n]